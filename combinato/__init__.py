@@ -30,9 +30,11 @@ from .constants import SPIKE_CLUST, SPIKE_MATCHED, SPIKE_MATCHED_2,\
     CLID_UNMATCHED, SIGNS, TYPE_NAMES, TYPE_ART, TYPE_MU, TYPE_SU,\
     TYPE_NO, GROUP_ART, GROUP_NOCLASS, TYPE_NON_NOISE, TYPE_ALL
 
-from .basics.nlxio import NcsFile, ncs_info, nev_read
+from .basics.nlxio import NcsFile, NevFile, ncs_info, ncs_header, nev_read,\
+    flush_header_caches
 from .basics.filters import DefaultFilter
 from .util.tools import h5files, get_channels, get_regions, check_status
+from .util.intervals import IntervalSet
 from .util.get_folder_structure import get_relevant_folders, get_time_files
 from .artifacts.mask_artifacts import id_to_name as artifact_id_to_name,\
     artifact_types
@@ -7,51 +7,121 @@
 
 from __future__ import print_function, division
 import os
+from argparse import ArgumentParser
+from multiprocessing import Pool, cpu_count
 import numpy as np
 import tables
-import time
 from .. import NcsFile, h5files, get_regions
 
 DEBUG = True
-BIN_MS = 3 
+BIN_MS = 3
+OUTFNAME = 'concurrent_times.h5'
 
-def bincount(ts_beg, ts_end, files, sign='pos'):
 
-    bins = np.arange(ts_beg, ts_end, BIN_MS)
-    count = np.zeros(len(bins) - 1, 'uint16')
-    nch = 0 # how many channels contribute?
-    for i, fn in enumerate(files):
-        times = times_from_file(fn, sign) 
-        if len(times):
-            nch += 1 
-            count += (np.histogram(times, bins)[0] > 0)
-            if DEBUG:
-                print('Added {}/{}'.format(i + 1, len(files)))
+def num_bins(ts_beg, ts_end):
+    """
+    number of bins of BIN_MS between ts_beg and ts_end,
+    same as len(np.arange(ts_beg, ts_end, BIN_MS)) - 1
+    """
+    return max(int(np.ceil((ts_end - ts_beg) / BIN_MS)) - 1, 0)
+
+
+def channel_bins(args):
+    """
+    indices of the bins that contain at least one spike,
+    or None if the file has no spikes
+    """
+    fname, sign, ts_beg, n_bins = args
+    times = times_from_file(fname, sign)
+    if not len(times):
+        return None
+    idx = np.floor_divide(times - ts_beg, BIN_MS).astype(np.int64)
+    return np.unique(idx[(idx >= 0) & (idx < n_bins)])
+
+
+def bincount(ts_beg, ts_end, files, sign='pos', n_workers=1):
+    """
+    count for each bin how many channels have spikes in it.
+    Channels are binned in parallel and added to the count as they finish
+    """
+    n_bins = num_bins(ts_beg, ts_end)
+    count = np.zeros(n_bins, 'uint16')
+    nch = 0  # how many channels contribute?
+    jobs = [(fname, sign, ts_beg, n_bins) for fname in files]
+
+    if n_workers > 1:
+        pool = Pool(n_workers)
+        results = pool.imap_unordered(channel_bins, jobs)
+    else:
+        pool = None
+        results = (channel_bins(job) for job in jobs)
+
+    for i, idx in enumerate(results):
+        if idx is not None:
+            nch += 1
+            count[idx] += 1
+        if DEBUG:
+            print('Added {}/{}'.format(i + 1, len(files)))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    return count, nch
 
-    return count, bins, nch 
+
+def count_to_runs(count):
+    """
+    run-length encoding of count, returns an array
+    with one row (first bin, number of bins, count) per run.
+    Runs with count 0 are left out
+    """
+    count = np.asarray(count)
+    if not count.shape[0]:
+        return np.zeros((0, 3), np.int64)
+    starts = np.hstack((0, np.diff(count).nonzero()[0] + 1))
+    lengths = np.diff(np.hstack((starts, count.shape[0])))
+    values = count[starts]
+    runs = np.vstack((starts, lengths, values)).T.astype(np.int64)
+    return runs[values > 0]
+
+
+def read_bincount(fname):
+    """
+    returns runs of the bincount and its attributes (nch, start, stop,
+    binms). Reads both run-length encoded and dense files
+    """
+    with tables.open_file(fname, 'r') as fid:
+        if '/runs' in fid:
+            node = fid.root.runs
+            runs = node[:]
+        else:
+            node = fid.root.count
+            runs = count_to_runs(node[:])
+        info = dict((key, node.attrs[key])
+                    for key in ('nch', 'start', 'stop', 'binms'))
+
+    return runs, info
 
 
 def _any_from_file(what, fname, sign='pos'):
 
-    failed = False 
     try:
-        h5file = tables.open_file(fname)
+        h5file = tables.open_file(fname, 'r')
     except IOError as e:
-        print(e.message + ' ' + fname)
+        print('{} {}'.format(e, fname))
+        return np.array([]) if what == 'times' else 0
+
+    try:
+        times = h5file.get_node('/' + sign + '/times')
+    except tables.exceptions.NoSuchNodeError as e:
+        print('{} {}'.format(e, fname))
         times = []
-        failed = True 
-   
-    if not failed:
-        try:
-            times = h5file.get_node('/' + sign + '/times')
-        except tables.exceptions.NoSuchNodeError as e:
-            print(e.message + ' ' + fname)
-            times = []
-       
+
     if what == 'times':
         # allocating this array consumes around 1 ms in our case,
         # not worth optimizing
-        ret = np.array(times) 
+        ret = np.array(times)
     elif what == 'nspk':
         ret = len(times)
     else:
@@ -75,12 +145,11 @@ def times_from_file(fname, sign='pos'):
     return _any_from_file('times', fname, sign)
 
 
-
-def write_bincount(folder):
+def write_bincount(folder, n_workers=1, dense=False):
     """
     get count for bin, save to file
     """
-    outfname = 'concurrent_times.h5'
+    outfname = OUTFNAME
 
     if os.path.exists(outfname):
         raise IOError('File exists: ' + outfname)
@@ -88,34 +157,53 @@ def write_bincount(folder):
     files = h5files(folder)
     if not len(files):
         raise ValueError('No spike data found in ' + folder)
-        
+
     ncsfiles = get_regions(folder)
 
     if len(ncsfiles) == 0:
         print('No ncs files found, reading from h5 files')
-        fid = tables.open_file(files[0], 'r')
-        ts_beg = fid.root.thr[0, 0]
-        ts_end = fid.root.thr[-1, 1]
+        with tables.open_file(files[0], 'r') as fid:
+            ts_beg = fid.root.thr[0, 0]
+            ts_end = fid.root.thr[-1, 1]
     else:
         ncsf = next(iter(ncsfiles.values()))[0]
         ncsfid = NcsFile(ncsf)
         ts_beg = float(ncsfid.read(0, 1, mode='timestamp'))/1000
-        ts_end = float(ncsfid.read(ncsfid.num_recs-1, 
-                                   ncsfid.num_recs, 
+        ts_end = float(ncsfid.read(ncsfid.num_recs-1,
+                                   ncsfid.num_recs,
                                    mode='timestamp'))/1000
 
     print(ts_beg, ts_end, (ts_end - ts_beg)/1000/60)
 
-    count, bins, nch = bincount(ts_beg, ts_end, files)
+    count, nch = bincount(ts_beg, ts_end, files, n_workers=n_workers)
+    runs = count_to_runs(count)
+    if DEBUG:
+        print('{} bins, {} runs with spikes'.format(count.shape[0],
+                                                    runs.shape[0]))
+
+    nodes = ['runs']
     outfile = tables.open_file(outfname, 'w')
-    outfile.create_array('/', 'count', count)
-    outfile.root.count.attrs['nch'] = nch
-    outfile.root.count.attrs['start'] = ts_beg
-    outfile.root.count.attrs['stop'] = ts_end
-    outfile.root.count.attrs['binms'] = BIN_MS 
+    outfile.create_array('/', 'runs', runs)
+    if dense:
+        outfile.create_array('/', 'count', count)
+        nodes.append('count')
+    for name in nodes:
+        attrs = outfile.get_node('/', name).attrs
+        attrs['nch'] = nch
+        attrs['start'] = ts_beg
+        attrs['stop'] = ts_end
+        attrs['binms'] = BIN_MS
     outfile.close()
 
 
 def main():
+    parser = ArgumentParser('css-find-concurrent',
+                            description='count channels with spikes'
+                                        ' in bins of {} ms'.format(BIN_MS))
+    parser.add_argument('--workers', type=int, default=cpu_count(),
+                        help='number of files read in parallel')
+    parser.add_argument('--dense', action='store_true', default=False,
+                        help='also store the count of every bin')
+    args = parser.parse_args()
     folder = os.getcwd()
-    write_bincount(folder)
+    write_bincount(folder, max(1, args.workers), args.dense)
@@ -10,17 +10,22 @@ different functions can be called to mark artifacts
 from __future__ import print_function, division, absolute_import
 import os
 from argparse import ArgumentParser
+from contextlib import contextmanager
+from multiprocessing import Pool, Semaphore, cpu_count
 
 import numpy as np
 import tables
 
-from .. import h5files
+from .. import h5files, IntervalSet
+from .concurrent import read_bincount
 
 SIGNS = ('pos', 'neg')
 DEBUG = True
 RESET = True  # set artifacts to 0 before analysis
 READONLY = False
 MODE = 'first'  # MODE can be 'first', 'last', or 'OR'
+CHUNK_ROWS = 100000  # spikes read at once
+IO_JOBS = 2  # processes that read or write h5 files at the same time
 
 
 options_by_diff = {'art_id': 1,   # to identify this type of artifact
@@ -52,6 +57,28 @@ id_to_name = {}
 for options in artifact_types:
     id_to_name[options['art_id']] = options['name']
 
+io_semaphore = None
+
+
+def init_worker(semaphore):
+    """
+    initializer for worker processes, sets the shared I/O semaphore
+    """
+    global io_semaphore
+    io_semaphore = semaphore
+
+
+@contextmanager
+def io_slot():
+    """
+    limits the number of processes doing h5 I/O at the same time
+    """
+    if io_semaphore is None:
+        yield
+    else:
+        with io_semaphore:
+            yield
+
 
 def add_id(artifacts, index, art_id, sign):
     """
@@ -86,47 +113,37 @@ def add_id(artifacts, index, art_id, sign):
 
 def mark_range_detection(times, ranges):
     """
-    Ranges contains a list of 2-tuples. All timestamps within
-    such a 2-tuple are excluded.
+    Ranges is an IntervalSet. All timestamps within
+    one of its intervals are excluded.
     """
-    artifacts = np.zeros(times.shape[0], dtype=bool)
-    for this_range in ranges:
-        idx = (times >= this_range[0]) & (times <= this_range[1])
-        print(this_range, times[0], times[-1])
-        print(idx.sum())
-        artifacts[idx] |= True
+    artifacts = ranges.contains(times)
+    if DEBUG:
+        print('{} ranges, {} spikes'.format(len(ranges), artifacts.sum()))
 
     return artifacts, options_ranges['art_id']
 
 
-def mark_double_detection(times, spikes, sign):
+def mark_double_detection(times, values, sign):
     """
     for spikes that are too close together,
-    keep only the one with the bigger amplitude
+    keep only the one with the bigger amplitude.
+    values are the spike amplitudes at options_double['relevant_idx']
     """
-
-    def mycmp(a, b, sign):
-        if sign == 'pos':
-            return a > b
-        elif sign == 'neg':
-            return a < b
+    min_dist = options_double['min_dist']
 
     artifacts = np.zeros(times.shape[0], dtype=bool)
-    min_dist = options_double['min_dist']
-    rel_idx = options_double['relevant_idx']
-    diff = np.diff(times)
-    double_idx = diff < min_dist
-
-    for i in double_idx.nonzero()[0]:
-        sp1 = spikes[i, rel_idx]
-        sp2 = spikes[i + 1, rel_idx]
-        if mycmp(sp1, sp2, sign):
-            kill = i + 1
-        else:
-            kill = i
-        artifacts[kill] = True
+    first = (np.diff(times) < min_dist).nonzero()[0]
 
-    print('{} dist < {}'.format((double_idx).sum(), min_dist))
+    if sign == 'pos':
+        first_wins = values[first] > values[first + 1]
+    elif sign == 'neg':
+        first_wins = values[first] < values[first + 1]
+    else:
+        raise ValueError('Unknown sign: ' + sign)
+
+    artifacts[np.where(first_wins, first + 1, first)] = True
+
+    print('{} dist < {}'.format(first.shape[0], min_dist))
     return artifacts, options_double['art_id']
 
 
@@ -137,167 +154,189 @@ def mark_by_diff(times):
     bin_len = options_by_diff['binlength']
     max_per_bin = options_by_diff['max_spk_per_bin']
 
-    artifacts = np.zeros(times.shape[0], dtype=bool)
+    edges = [np.zeros(0)]
 
     for shift in (0, bin_len/2):
         bins = np.arange(times[0] + shift, times[-1] + shift, bin_len)
         if len(bins) < 2:
             continue
         counts, _ = np.histogram(times, bins)
-        left_edges_too_many = bins[:-1][counts > max_per_bin]
-        # try a loop, but maybe too slow?
-        if DEBUG:
-            print('looping over {} edges'.format(left_edges_too_many.shape[0]))
-        for edge in left_edges_too_many:
-            idx = (times >= edge) & (times <= edge + bin_len)
-            artifacts[idx] = True
+        edges.append(bins[:-1][counts > max_per_bin])
+
+    edges = np.hstack(edges)
+    if DEBUG:
+        print('marking {} edges'.format(edges.shape[0]))
+
+    artifacts = IntervalSet(edges, edges + bin_len).contains(times)
 
     return artifacts, options_by_diff['art_id']
 
 
 def bincount_to_edges(concurrent_fname):
     """
-    helper, transforms bincount to edges
+    helper, transforms bincount to intervals of bins
+    with events in too many channels
     """
-    conc_fid = tables.open_file(concurrent_fname, 'r')
-    count = conc_fid.root.count[:]
-    attrs = conc_fid.root.count.attrs
-    num_channels = attrs['nch']
-    start = attrs['start']
-    stop = attrs['stop']
-    bin_len = attrs['binms']
-    conc_fid.close()
-    bins = np.arange(start, stop, bin_len)
-    cutoff = options_by_bincount['max_frac_ch'] * num_channels
+    runs, info = read_bincount(concurrent_fname)
+    cutoff = options_by_bincount['max_frac_ch'] * info['nch']
     if DEBUG:
         print('Using cutoff of {:.0f} channels'.format(cutoff))
-    exclusion_left_edges = bins[:-1][count > cutoff]
-    return exclusion_left_edges, bin_len
+    runs = runs[runs[:, 2] > cutoff]
+    bin_len = info['binms']
+    starts = info['start'] + runs[:, 0] * bin_len
+    stops = info['start'] + (runs[:, 0] + runs[:, 1]) * bin_len
+    return IntervalSet(starts, stops)
 
 
-def mark_by_bincount(times, left_edges, bin_len):
+def mark_by_bincount(times, intervals):
     """
-    marks bins with events in too many other channels (specified by counts)
+    marks bins with events in too many other channels (specified by counts),
+    intervals is an IntervalSet of such bins
     """
     if DEBUG:
-        print('all channel rejection, looping over {} edges'.
-              format(left_edges.shape[0]))
-
-    artifacts = np.zeros(times.shape[0], dtype=bool)
+        print('all channel rejection, marking {} intervals'.
+              format(len(intervals)))
 
-    for edge in left_edges:
-        idx = (times >= edge) & (times <= edge + bin_len)
-        artifacts[idx] = True
+    artifacts = intervals.contains(times)
 
     return artifacts, options_by_bincount['art_id']
 
 
-def mark_by_height(spikes, sign):
+def mark_by_height(peaks, sign):
     """
-    marks spikes that exceed a height criterion
+    marks spikes that exceed a height criterion.
+    peaks are the maxima of positive or the minima of negative spikes
     """
     max_height = options_by_height['max_height']
 
     if sign == 'pos':
-        artifacts = spikes.max(1) >= max_height
+        artifacts = peaks >= max_height
     elif sign == 'neg':
-        artifacts = spikes.min(1) <= -max_height
+        artifacts = peaks <= -max_height
     else:
         raise ValueError('Unknown sign: ' + sign)
 
     return artifacts, options_by_height['art_id']
 
 
-def main(fname, concurrent_edges=None, concurrent_bin=None,
-         exlude_ranges=None):
+def read_features(fname, sign):
     """
-    creates table to store artifact information
+    reads times, peak values, and the amplitudes at relevant_idx
+    of all spikes of one sign. Spikes are read in chunks of CHUNK_ROWS,
+    so the full spike matrix is never in memory.
+    Returns None if there are no spikes
     """
-    for sign in SIGNS:
-
-        # why is this here?
-        if READONLY:
-            mode = 'r'
-        else:
-            mode = 'r+'
-        h5fid = tables.open_file(fname, mode)
+    rel_idx = options_double['relevant_idx']
+    peak_func = np.max if sign == 'pos' else np.min
 
+    with tables.open_file(fname, 'r') as h5fid:
         try:
             node = h5fid.get_node('/' + sign + '/times')
         except tables.NoSuchNodeError:
             print('{} has no {} spikes'.format(fname, sign))
-            h5fid.close()
-            continue
-
-        if len(node.shape) == 0:
-            h5fid.close()
-            continue
+            return None
 
-        elif node.shape[0] == 0:
-            h5fid.close()
-            continue
+        if len(node.shape) == 0 or node.shape[0] == 0:
+            return None
 
         times = node[:]
         num_spk = times.shape[0]
 
-        spikes = h5fid.get_node('/' + sign, 'spikes')[:, :]
+        spk_node = h5fid.get_node('/' + sign, 'spikes')
+        assert num_spk == spk_node.shape[0]
+
+        peaks = np.empty(num_spk, dtype=spk_node.dtype)
+        relevant = np.empty(num_spk, dtype=spk_node.dtype)
+        for start in range(0, num_spk, CHUNK_ROWS):
+            stop = min(start + CHUNK_ROWS, num_spk)
+            chunk = spk_node[start:stop]
+            peaks[start:stop] = peak_func(chunk, 1)
+            relevant[start:stop] = chunk[:, rel_idx]
+
+        artifacts = np.zeros(num_spk, dtype=np.int8)
+        if not RESET:
+            try:
+                old = h5fid.get_node('/' + sign + '/artifacts')
+                if old.shape == (num_spk, ):
+                    artifacts = old[:]
+            except tables.NoSuchNodeError:
+                pass
+
+    return times, peaks, relevant, artifacts
 
-        assert num_spk == spikes.shape[0]
 
+def write_artifacts(fname, sign, artifacts, ranges=None):
+    """
+    stores the artifacts array of one sign,
+    and the exclusion ranges if given (otherwise removes them)
+    """
+    with tables.open_file(fname, 'r+') as h5fid:
         try:
-            artifacts = h5fid.get_node('/' + sign + '/artifacts')
+            node = h5fid.get_node('/' + sign + '/artifacts')
+            if node.shape != artifacts.shape:
+                node.remove()
+                node = None
         except tables.NoSuchNodeError:
-            h5fid.create_array('/' + sign, 'artifacts',
-                               atom=tables.Int8Atom(), shape=(num_spk, ))
-            artifacts = h5fid.get_node('/' + sign + '/artifacts')
-        if RESET:
-            artifacts[:] = 0
+            node = None
+
+        if node is None:
+            h5fid.create_array('/' + sign, 'artifacts', artifacts)
+        else:
+            node[:] = artifacts
+
+        # ranges of an earlier run must not remain
+        if ranges is not None:
+            ranges.to_h5(h5fid, '/' + sign, 'exclude_ranges')
+        elif '/' + sign + '/exclude_ranges' in h5fid:
+            h5fid.remove_node('/' + sign, 'exclude_ranges')
+
+
+def main(fname, concurrent_intervals=None, exlude_ranges=None):
+    """
+    creates table to store artifact information
+    """
+    for sign in SIGNS:
+        with io_slot():
+            features = read_features(fname, sign)
+
+        if features is None:
+            continue
+
+        times, peaks, relevant, artifacts = features
 
         arti_by_diff, arti_by_diff_id = mark_by_diff(times)
         add_id(artifacts, arti_by_diff, arti_by_diff_id, sign)
-        # artifacts[arti_by_diff != 0] = arti_by_diff_id
 
-        # if DEBUG:
-        #    print('Marked {} {} spikes by diff'.
-        #          format(arti_by_diff.sum(), sign))
-
-        arti_by_height, arti_by_height_id = mark_by_height(spikes, sign)
+        arti_by_height, arti_by_height_id = mark_by_height(peaks, sign)
         add_id(artifacts, arti_by_height, arti_by_height_id, sign)
 
-        # artifacts[arti_by_height != 0] = arti_by_height_id
-        # if DEBUG:
-        #    print('Marked {} {} spikes by height'.
-        #          format(arti_by_height.sum(), sign))
-
-        arti_by_double, double_id = mark_double_detection(times, spikes, sign)
+        arti_by_double, double_id = mark_double_detection(times, relevant,
+                                                          sign)
         add_id(artifacts, arti_by_double, double_id, sign)
-        # artifacts[arti_by_double != 0] = double_id
-        # if DEBUG:
-        #    print('Marked {} {} spikes as detected twice'.
-        #          format(arti_by_double.sum(), sign))
-
-        if concurrent_edges is not None:
-            arti_by_conc, arti_by_conc_id = mark_by_bincount(times,
-                                                             concurrent_edges,
-                                                             concurrent_bin)
-            add_id(artifacts, arti_by_conc, arti_by_conc_id, sign)
 
-            # artifacts[arti_by_conc != 0] = arti_by_conc_id
-            # if DEBUG:
-            #    print('Marked {} {} spikes by concurrent occurence'.
-            #          format(arti_by_conc.sum(), sign))
+        if concurrent_intervals is not None:
+            arti_by_conc, arti_by_conc_id =\
+                mark_by_bincount(times, concurrent_intervals)
+            add_id(artifacts, arti_by_conc, arti_by_conc_id, sign)
 
         if exlude_ranges is not None:
             arti_by_ranges, range_id = mark_range_detection(times,
                                                             exlude_ranges)
             add_id(artifacts, arti_by_ranges, range_id, sign)
-            # artifacts[arti_by_ranges != 0] = range_id
 
-            # if DEBUG:
-            #    print('Marked {} {} spikes within supplied range '.
-            #          format(arti_by_ranges.sum(), sign))
+        if not READONLY:
+            with io_slot():
+                write_artifacts(fname, sign, artifacts, exlude_ranges)
 
-        h5fid.close()
+
+def main_helper(args):
+    """
+    wrapper for Pool.map
+    """
+    fname = args[0]
+    if DEBUG:
+        print('Starting ' + fname)
+    main(*args)
 
 
 def parse_args():
@@ -307,6 +346,11 @@ def parse_args():
     parser.add_argument('--concurrent-file', nargs=1)
     parser.add_argument('--exclude-ranges', nargs=1,
                         help='supply a file with timestamp ranges to exclude')
+    parser.add_argument('--workers', type=int, default=cpu_count(),
+                        help='number of files processed in parallel')
+    parser.add_argument('--io-jobs', type=int, default=IO_JOBS,
+                        help='number of workers that read or write'
+                             ' h5 files at the same time')
     args = parser.parse_args()
 
     if args.concurrent_file:
@@ -315,11 +359,10 @@ def parse_args():
         conc_fname = CONC_FNAME
 
     if os.path.isfile(conc_fname):
-        concurrent_edges, concurrent_bin =\
-            bincount_to_edges(conc_fname)
+        concurrent_intervals = bincount_to_edges(conc_fname)
     else:
         print('Not using concurrent spike detection')
-        concurrent_edges = concurrent_bin = None
+        concurrent_intervals = None
 
     if args.file:
         fname = args.file[0]
@@ -338,15 +381,26 @@ def parse_args():
             for line in fid.readlines():
                 ranges = [float(x) for x in line.strip().split()]
                 exclude_ranges.append(ranges)
+        exclude_ranges = IntervalSet.from_pairs(exclude_ranges)
     else:
         exclude_ranges = None
 
-    # main loop, could be done with parallel
-    # processing (bad because of high I/O)
-    for fname in files:
-        if DEBUG:
-            print('Starting ' + fname)
-        main(fname, concurrent_edges, concurrent_bin, exclude_ranges)
+    jobs = [(fname, concurrent_intervals, exclude_ranges)
+            for fname in files]
+    n_workers = max(1, min(args.workers, len(files)))
+
+    if n_workers == 1:
+        for job in jobs:
+            main_helper(job)
+    else:
+        # marking is fast, so h5 reading and writing is limited
+        # to io_jobs processes at a time
+        print('Starting {} workers, {} at a time reading or writing'.
+              format(n_workers, args.io_jobs))
+        pool = Pool(n_workers, init_worker, (Semaphore(args.io_jobs), ))
+        pool.map(main_helper, jobs, chunksize=1)
+        pool.close()
+        pool.join()
 
 if __name__ == "__main__":
     parse_args()
@@ -5,7 +5,7 @@ Simple signal filtering for spike extraction
 """
 from __future__ import absolute_import, division
 import numpy as np
-from scipy.signal import ellip, filtfilt
+from scipy.signal import ellip, sosfiltfilt
 
 # pylint:   disable=invalid-name, unbalanced-tuple-unpacking, E1101
 
@@ -14,47 +14,77 @@ DETECT_HIGH = 1000      # default 1000
 EXTRACT_LOW = 300       # default 300
 EXTRACT_HIGH = 3000     # default 3000
 
+# filter designs by timestep, shared by all filters of a process
+designs = {}
+
+
+def design_filters(timestep):
+    """
+    returns second-order sections for detection, extraction,
+    and notch filter, designs are computed once per timestep
+    """
+    if timestep not in designs:
+        c_detect = ellip(2, .1, 40,
+                         (2 * timestep * DETECT_LOW,
+                          2 * timestep * DETECT_HIGH),
+                         'bandpass', output='sos')
+        c_extract = ellip(2, .1, 40,
+                          (2 * timestep * EXTRACT_LOW,
+                           2 * timestep * EXTRACT_HIGH),
+                          'bandpass', output='sos')
+        c_notch = ellip(2, .5, 20,
+                        (2 * timestep * 1999, 2 * timestep * 2001),
+                        'bandstop', output='sos')
+        designs[timestep] = (c_detect, c_extract, c_notch)
+
+    return designs[timestep]
+
 
 class DefaultFilter(object):
     """
-    Simple filters for spike extraction
+    Simple filters for spike extraction,
+    dtype can be np.float32 to save memory and time
     """
 
-    def __init__(self, timestep):
+    def __init__(self, timestep, dtype=np.float64):
         self.sampling_rate = int(1. / timestep)
         self.timestep = timestep
-        self.c_detect = ellip(2, .1, 40,
-                              (2 * timestep * DETECT_LOW,
-                               2 * timestep * DETECT_HIGH),
-                              'bandpass')
-        self.c_extract = ellip(2, .1, 40,
-                               (2 * timestep * EXTRACT_LOW,
-                                2 * timestep * EXTRACT_HIGH),
-                               'bandpass')
-        self.c_notch = ellip(2, .5, 20,
-                             (2 * timestep * 1999, 2 * timestep * 2001),
-                             'bandstop')
+        self.dtype = dtype
+        self.c_detect, self.c_extract, self.c_notch =\
+            [sos.astype(dtype) for sos in design_filters(timestep)]
+
+    def _filter(self, sos, x):
+        """
+        zero-phase filtering along the last axis
+        """
+        return sosfiltfilt(sos, np.asarray(x, self.dtype))
 
     def filter_detect(self, x):
         """
         filter for spike detection
         """
-        b, a = self.c_detect
-        return filtfilt(b, a, x)
+        return self._filter(self.c_detect, x)
 
     def filter_extract(self, x):
         """
         filter for spike extraction
         """
-        b, a = self.c_extract
-        return filtfilt(b, a, x)
+        return self._filter(self.c_extract, x)
 
     def filter_denoise(self, x):
         """
         notch filter to remove higher harmonics of 50/60 cycle
         """
-        b, a = self.c_notch
-        return filtfilt(b, a, x)
+        return self._filter(self.c_notch, x)
+
+    def filter_chain(self, x, denoise=True):
+        """
+        returns detection and extraction filtered data,
+        the notch filter is applied only once for both
+        """
+        if denoise:
+            x = self.filter_denoise(x)
+        return self.filter_detect(x), self.filter_extract(x)
 
 
 def nonlinear(x):
@@ -4,8 +4,11 @@ Basic i/o definitions for Neuralynx files
 """
 
 from __future__ import print_function, division, absolute_import
+import os
 from os import stat
+import atexit
 from datetime import datetime
+import json
 import re
 import numpy as np
 # pylint: disable=E1101
@@ -14,6 +17,15 @@ NCS_SAMPLES_PER_REC = 512
 NLX_OFFSET = 16 * 1024
 NCS_RECSIZE = 1044
 
+# headers, numbers of records, and timesteps of ncs files
+# are cached in this file in the folder of the ncs files
+HEADER_CACHE_FNAME = '.ncs_headers.json'
+USE_HEADER_CACHE = True
+# caches by folder, read from disk once per process
+header_caches = {}
+# keys of entries added since the last write, by folder
+dirty_entries = {}
+
 # Time Pattern tries to deal with the messed up
 # time representation in Neuralynx ncs file headers
 TIME_PATTERN = re.compile(r'(\d{1,2}:\d{1,2}:\d{1,2}).(\d{1,3})')
@@ -58,30 +70,80 @@ def nev_string_read(filename):
     return np.array([eventmap['timestamp'], eventmap['ev_string']]).T
 
 
+class NevFile(object):
+    """
+    events of a Neuralynx .nev file in a structured array
+    with fields 'timestamp', 'nttl', and 'ev_string',
+    sorted by timestamp. Time ranges are found by binary search.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        eventmap = np.memmap(filename, dtype=nev_type, mode='r',
+                             offset=NLX_OFFSET)
+        order = np.argsort(eventmap['timestamp'], kind='mergesort')
+        self.events = np.empty(order.shape[0],
+                               np.dtype([('timestamp', 'u8'),
+                                         ('nttl', 'i2'),
+                                         ('ev_string', 'S128')]))
+        for field in self.events.dtype.names:
+            self.events[field] = eventmap[field][order]
+        self.timestamps = self.events['timestamp']
+        # events of each ttl value, computed on demand
+        self.by_ttl = {}
+
+    def __len__(self):
+        return self.events.shape[0]
+
+    def ttl_events(self, nttl):
+        """
+        all events with the ttl value nttl
+        """
+        if nttl not in self.by_ttl:
+            self.by_ttl[nttl] = self.events[self.events['nttl'] == nttl]
+        return self.by_ttl[nttl]
+
+    def events_between(self, start, stop, nttl=None):
+        """
+        events with start <= timestamp <= stop (in microseconds),
+        only those with the ttl value nttl if it is given
+        """
+        if nttl is None:
+            events = self.events
+        else:
+            events = self.ttl_events(nttl)
+        times = events['timestamp']
+        return events[np.searchsorted(times, start, 'left'):
+                      np.searchsorted(times, stop, 'right')]
+
+
 class NcsFile(object):
     """
     represents ncs files, allows to read data and time
+
+    With use_memmap=True, the file is mapped into memory once,
+    and view() returns strided views into the records
+    without copying data
     """
-    def __init__(self, filename):
+    def __init__(self, filename, use_memmap=False):
         self.file = None
+        self.memmap = None
         self.filename = filename
-        self.num_recs = ncs_num_recs(filename)
-        self.header = ncs_info(filename)
-        self.file = open(filename, 'rb')
-        if self.num_recs > 0:
-            timestamp = self.read(0, 2, 'timestamp')
-            self.timestep = float((timestamp[1] - timestamp[0]))
-            self.timestep /= NCS_SAMPLES_PER_REC * 1e6
+        self.header, self.num_recs, self.timestep = ncs_metadata(filename)
+        if use_memmap:
+            if self.num_recs > 0:
+                self.memmap = np.memmap(filename, dtype=ncs_type, mode='r',
+                                        offset=NLX_OFFSET,
+                                        shape=(self.num_recs,))
         else:
-            self.timestep = None
+            self.file = open(filename, 'rb')
 
     def __del__(self):
         if self.file is not None:
             self.file.close()
 
-    def read(self, start=0, stop=None, mode='data'):
+    def _records(self, start, stop):
         """
-        read data, timestamps, or info fields from ncs file
+        helper, returns the records from start to stop
         """
         if stop > start:
             length = stop - start
@@ -91,16 +153,56 @@ class NcsFile(object):
             raise IOError("Request to read beyond EOF,"
                           "filename %s, start %i, stop %i" %
                           (self.filename, start, stop))
-        else:
-            self.file.seek(NLX_OFFSET + start * NCS_RECSIZE)
-            data = self.file.read(length * NCS_RECSIZE)
-            array_length = int(len(data) / NCS_RECSIZE)
-            array_data = np.ndarray(array_length, ncs_type, data)
-            if mode == 'both':
-                return (array_data['data'].flatten(),
-                        array_data['timestamp'].flatten())
-            elif mode in ('data', 'timestamp', 'info'):
-                return array_data[mode].flatten()
+        if self.memmap is not None:
+            return self.memmap[start:start + length]
+        if self.file is None:
+            # memory map of a file without records
+            return np.zeros(0, ncs_type)
+
+        self.file.seek(NLX_OFFSET + start * NCS_RECSIZE)
+        data = self.file.read(length * NCS_RECSIZE)
+        array_length = int(len(data) / NCS_RECSIZE)
+        return np.ndarray(array_length, ncs_type, data)
+
+    def advise(self, start=0, stop=None):
+        """
+        tell the operating system that records start to stop
+        will be read soon, where os.posix_fadvise is available
+        """
+        if not hasattr(os, 'posix_fadvise'):
+            return
+        if stop is None:
+            stop = self.num_recs
+        fid = os.open(self.filename, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fid, NLX_OFFSET + start * NCS_RECSIZE,
+                             (stop - start) * NCS_RECSIZE,
+                             os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fid)
+
+    def view(self, start=0, stop=None, mode='data'):
+        """
+        like read, but returns the fields record-wise,
+        data has shape (num_records, NCS_SAMPLES_PER_REC).
+        In memmap mode, no data are copied.
+        """
+        array_data = self._records(start, stop)
+        if mode == 'both':
+            return array_data['data'], array_data['timestamp']
+        elif mode in ('data', 'timestamp', 'info'):
+            return array_data[mode]
+
+    def read(self, start=0, stop=None, mode='data'):
+        """
+        read data, timestamps, or info fields from ncs file
+        """
+        array_data = self._records(start, stop)
+        if mode == 'both':
+            return (array_data['data'].flatten(),
+                    array_data['timestamp'].flatten())
+        elif mode in ('data', 'timestamp', 'info'):
+            return array_data[mode].flatten()
 
 
 def ncs_info(filename):
@@ -168,3 +270,146 @@ def ncs_num_recs(filename):
         raise Exception("%s has the wrong size" % filename)
     else:
         return int(data_size / NCS_RECSIZE)
+
+
+def ncs_timestep(filename):
+    """
+    timestep (in seconds) between samples of an ncs file,
+    from the timestamps of the first two records
+    """
+    with open(filename, 'rb') as fid:
+        fid.seek(NLX_OFFSET)
+        data = fid.read(2 * NCS_RECSIZE)
+    timestamp = np.frombuffer(data, ncs_type)['timestamp']
+    if timestamp.shape[0] < 2:
+        return None
+    return float(timestamp[1] - timestamp[0]) / (NCS_SAMPLES_PER_REC * 1e6)
+
+
+def header_to_json(header):
+    """
+    datetimes are stored as lists of their fields
+    """
+    ret = {}
+    for key, value in header.items():
+        if isinstance(value, datetime):
+            value = {'datetime': [value.year, value.month, value.day,
+                                  value.hour, value.minute, value.second,
+                                  value.microsecond]}
+        ret[key] = value
+    return ret
+
+
+def header_from_json(header):
+    """
+    inverse of header_to_json
+    """
+    ret = {}
+    for key, value in header.items():
+        if isinstance(value, dict) and 'datetime' in value:
+            value = datetime(*value['datetime'])
+        ret[key] = value
+    return ret
+
+
+def read_header_cache(folder):
+    """
+    the header cache of a folder, read from disk once per process
+    """
+    if folder not in header_caches:
+        fname = os.path.join(folder, HEADER_CACHE_FNAME)
+        cache = {}
+        if os.path.exists(fname):
+            try:
+                with open(fname, 'r') as fid:
+                    cache = json.load(fid)
+            except (IOError, OSError, ValueError):
+                print('Ignoring unreadable header cache ' + fname)
+        header_caches[folder] = cache
+    return header_caches[folder]
+
+
+def write_header_cache(folder):
+    """
+    write the new entries of the header cache of a folder.
+    The file is read again first, so entries written by other
+    processes in the meantime are kept.
+    Folders without write permission are skipped
+    """
+    fname = os.path.join(folder, HEADER_CACHE_FNAME)
+    keys = dirty_entries.pop(folder, set())
+    if not keys:
+        return
+
+    cache = header_caches[folder]
+    on_disk = {}
+    if os.path.exists(fname):
+        try:
+            with open(fname, 'r') as fid:
+                on_disk = json.load(fid)
+        except (IOError, OSError, ValueError):
+            pass
+    on_disk.update((key, cache[key]) for key in keys)
+    cache.update(on_disk)
+
+    tmp_fname = '{}.{}'.format(fname, os.getpid())
+    try:
+        with open(tmp_fname, 'w') as fid:
+            json.dump(on_disk, fid)
+        os.replace(tmp_fname, fname)
+    except (IOError, OSError):
+        pass
+
+
+def flush_header_caches():
+    """
+    write all header caches with new entries,
+    called after listing a folder and at exit
+    """
+    for folder in list(dirty_entries):
+        write_header_cache(folder)
+
+
+atexit.register(flush_header_caches)
+
+
+def ncs_metadata(filename):
+    """
+    returns header, number of records, and timestep of an ncs file.
+    The values are cached in HEADER_CACHE_FNAME in the folder
+    of the file, the file is read again if its size, modification time,
+    inode, or change time differ from the cached ones
+    """
+    statr = stat(filename)
+    # a rename keeps size and mtime, but changes ctime
+    signature = [statr.st_size, statr.st_mtime, statr.st_ino,
+                 getattr(statr, 'st_ctime_ns', statr.st_ctime)]
+    folder = os.path.dirname(os.path.abspath(filename))
+    key = os.path.basename(filename)
+
+    if USE_HEADER_CACHE:
+        cache = read_header_cache(folder)
+        entry = cache.get(key)
+        if entry is not None and entry['signature'] == signature:
+            return (header_from_json(entry['header']), entry['num_recs'],
+                    entry['timestep'])
+
+    header = ncs_info(filename)
+    num_recs = ncs_num_recs(filename)
+    timestep = ncs_timestep(filename) if num_recs > 0 else None
+
+    if USE_HEADER_CACHE:
+        cache[key] = {'signature': signature,
+                      'header': header_to_json(header),
+                      'num_recs': num_recs,
+                      'timestep': timestep}
+        dirty_entries.setdefault(folder, set()).add(key)
+
+    return header, num_recs, timestep
+
+
+def ncs_header(filename):
+    """
+    header of an ncs file, from the cache if possible
+    """
+    return ncs_metadata(filename)[0]
@@ -5,10 +5,21 @@
 from __future__ import division, print_function, absolute_import
 import os
 from argparse import ArgumentParser, FileType
+from multiprocessing import cpu_count
 import tables
-from .mp_extract import mp_extract
+from .mp_extract import mp_extract, MAX_PENDING_MB, PREFETCH_BLOCKS
+from .tools import H5_LAYOUTS, read_checkpoint, h5_sampling_rate,\
+    matfile_info, nsx_layout, InterleavedBinaryFile, checkpoint_block
 from .. import NcsFile
 
+# memory one worker needs, in multiples of the raw block size
+# (float32 data, filtered copies, temporaries)
+WORKER_MEMORY_FACTOR = 12
+# number of workers before it depended on cores and memory
+DEFAULT_WORKERS = 5
+# length of blocks of h5 files and matfiles
+BLOCK_SECONDS = 5 * 60
+
 
 def get_nrecs(filename):
     fid = NcsFile(filename)
@@ -17,15 +28,188 @@ def get_nrecs(filename):
 def get_h5size(filename):
     fid = tables.open_file(filename, 'r')
     n = fid.root.data.shape[0]
+    sr = h5_sampling_rate(fid)
     fid.close()
-    return n
+    return n, sr
+
+
+def sample_block_jobs(name, filename, size, sr, extra):
+    """
+    jobs for blocks of BLOCK_SECONDS of a file with size samples
+    """
+    blocksize = int(sr * BLOCK_SECONDS)
+    starts = list(range(0, size, blocksize))
+    stops = starts[1:] + [size]
+    jobs = []
+    for i in range(len(starts)):
+        jdict = {'name': name,
+                 'filename': filename,
+                 'start': starts[i],
+                 'stop': stops[i],
+                 'count': i,
+                 'blocksize': blocksize}
+        jdict.update(extra)
+        jobs.append(jdict)
+
+    return jobs
+
+
+def record_blocks(nrecs, start, stop, blocksize):
+    """
+    start and stop records of the blocks of a file,
+    a short last block is joined to the one before
+    """
+    if start is None:
+        start = 0
+    if stop:
+        stop = min(stop, nrecs)
+    else:
+        stop = nrecs
+
+    if stop % blocksize > blocksize/2:
+        laststart = stop-blocksize
+    else:
+        laststart = stop
+
+    starts = list(range(start, laststart, blocksize))
+    stops = starts[1:] + [stop]
+    return starts, stops
+
+
+def binary_jobs(fname, layout, scales, labels, args, extra):
+    """
+    jobs for all channels of an interleaved binary file
+    """
+    base = os.path.splitext(os.path.basename(fname))[0]
+    jobs = []
+    for channel in range(layout['n_channels']):
+        binary = dict(layout, channel=channel, scale=scales[channel])
+        reader = InterleavedBinaryFile(fname, **binary)
+        starts, stops = record_blocks(reader.num_recs, args.start,
+                                      args.stop, args.blocksize)
+        name = base + '_' + labels[channel]
+        print(name)
+        for i in range(len(starts)):
+            jdict = {'name': name,
+                     'filename': fname,
+                     'binary': binary,
+                     'start': starts[i],
+                     'stop': stops[i],
+                     'count': i,
+                     'blocksize': args.blocksize,
+                     'reference': None}
+            jdict.update(extra)
+            jobs.append(jdict)
+
+    return jobs
+
+
+def available_memory():
+    """
+    available physical memory in bytes, None if unknown.
+    Uses MemAvailable, which counts the page cache as available,
+    and falls back to the total physical memory
+    """
+    try:
+        with open('/proc/meminfo', 'r') as fid:
+            for line in fid:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def usable_cores():
+    """
+    number of cores this process may run on
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return cpu_count()
+
+
+def default_workers(blocksize, max_pending_mb):
+    """
+    number of workers that fit into the number of cores and memory.
+    The memory estimate never reduces the number below DEFAULT_WORKERS
+    """
+    n_workers = max(1, usable_cores() - 2)
+    memory = available_memory()
+    if memory is not None:
+        block_bytes = blocksize * 512 * 4
+        memory -= max_pending_mb * 2**20
+        by_memory = int(memory / (WORKER_MEMORY_FACTOR * block_bytes))
+        n_workers = min(n_workers, max(by_memory, DEFAULT_WORKERS))
+
+    return max(1, n_workers)
+
+
+def check_resume(name, checkpoint, jobs):
+    """
+    make sure that the block recorded in the checkpoint
+    is the block with the same count in jobs,
+    otherwise blocks would be skipped or written twice
+    """
+    matching = [job for job in jobs if job['count'] == checkpoint['count']]
+    if not matching:
+        raise ValueError('{}: checkpoint is at block {}, but there are only'
+                         ' {} blocks. Cannot resume with different'
+                         ' settings, run without --resume.'.
+                         format(name, checkpoint['count'], len(jobs)))
+
+    expected = checkpoint_block(matching[0])
+    for key, value in expected.items():
+        if key in checkpoint and checkpoint[key] != value:
+            raise ValueError('{}: block {} has {} {} in the checkpoint,'
+                             ' but {} now. Use the settings of the'
+                             ' interrupted run (--blocksize, --start,'
+                             ' --stop), or run without --resume.'.
+                             format(name, checkpoint['count'], key,
+                                    checkpoint[key], value))
+
+
+def skip_finished(jobs):
+    """
+    drop jobs that are already written according to
+    the checkpoints of their spike files
+    """
+    checkpoints = {}
+    by_name = {}
+    for job in jobs:
+        by_name.setdefault(job['name'], []).append(job)
+
+    ret = []
+    for job in jobs:
+        name = job['name']
+        if name not in checkpoints:
+            checkpoints[name] = read_checkpoint(name, 'data_' + name + '.h5',
+                                                job['destination'])
+            if checkpoints[name] is not None:
+                check_resume(name, checkpoints[name], by_name[name])
+                print('{}: blocks up to {} are done'.
+                      format(name, checkpoints[name]['count']))
+        checkpoint = checkpoints[name]
+        if checkpoint is None:
+            ret.append(job)
+        elif job['count'] > checkpoint['count']:
+            job.update(resume_count=checkpoint['count'])
+            ret.append(job)
+
+    print('Resuming {} of {} jobs'.format(len(ret), len(jobs)))
+    return ret
 
 
 def main():
     """standard main function"""
-    # standard options
-    nWorkers = 5
-    blocksize = 10000
+    # blocks are read with this many records of overlap on each side,
+    # so that filters settle and spikes at block borders are found
+    overlap = 4
 
     parser = ArgumentParser(prog='css-extract',
                             description='spike extraction from .ncs files',
@@ -45,18 +229,60 @@ def main():
     parser.add_argument('--matfile-scale-factor', nargs='?', type=float,
                         help='rescale matfile data by this factor'
                              ' (to obtain microvolts)', default=1)
+    parser.add_argument('--binary', nargs=1,
+                        help='extract all channels of a flat binary file'
+                             ' of interleaved int16 samples')
+    parser.add_argument('--binary-channels', type=int,
+                        help='number of channels in the binary file')
+    parser.add_argument('--binary-sr', type=float, default=32000,
+                        help='sampling rate of the binary file')
+    parser.add_argument('--binary-scale', type=float, default=1,
+                        help='microvolts per bit of the binary file')
+    parser.add_argument('--binary-header-bytes', type=int, default=0,
+                        help='bytes before the first sample')
+    parser.add_argument('--nsx', nargs=1,
+                        help='extract all channels of a Blackrock NSx file')
     parser.add_argument('--destination', nargs=1,
                         help='folder where spikes should be saved')
     parser.add_argument('--refscheme', nargs=1, type=FileType(mode='r'),
                         help='scheme for re-referencing')
+    parser.add_argument('--workers', type=int,
+                        help='number of worker processes'
+                             ' (default: depends on cores and memory)')
+    parser.add_argument('--savers', type=int, default=1,
+                        help='number of saver processes,'
+                             ' each channel is written by one saver')
+    parser.add_argument('--blocksize', type=int, default=10000,
+                        help='records per block (default 10000)')
+    parser.add_argument('--max-pending-mb', type=int, default=MAX_PENDING_MB,
+                        help='memory for blocks that are read'
+                             ' but not yet saved')
+    parser.add_argument('--prefetch', type=int, default=PREFETCH_BLOCKS,
+                        help='blocks of ncs files that are read ahead'
+                             ' by reader threads, 0 to read in order')
+    parser.add_argument('--h5-layout', choices=sorted(H5_LAYOUTS),
+                        default='default',
+                        help='chunking and compression of the spike files')
+    parser.add_argument('--resume', action='store_true', default=False,
+                        help='skip blocks that were written by'
+                             ' an interrupted run')
     args = parser.parse_args()
 
+    blocksize = args.blocksize
+    if args.workers is not None:
+        nWorkers = args.workers
+    else:
+        nWorkers = default_workers(blocksize, args.max_pending_mb)
+    print('Using {} workers and {} savers'.format(nWorkers, args.savers))
+
     if ((args.files is None) and 
         (args.matfile is None) and 
-        (args.jobs is None)):
+        (args.jobs is None) and
+        (args.binary is None) and
+        (args.nsx is None)):
 
         parser.print_help()
-        print('Supply either files or jobs or matfile.')
+        print('Supply either files or jobs or matfile or binary/nsx file.')
         return
 
     if args.destination is not None:
@@ -64,19 +290,51 @@ def main():
     else:
         destination = ''
 
-    # special case for a matlab file
+    # a matlab file is split into blocks like h5 files
     if args.matfile is not None:
-        jname = os.path.splitext(os.path.basename(args.matfile[0]))[0]
-        jobs = [{'name': jname,
-                 'filename': args.matfile[0],
-                 'is_matfile': True,
-                 'count': 0,
-                 'destination': destination,
-                 'scale_factor': args.matfile_scale_factor}]
-        mp_extract(jobs, 1)
+        fname = args.matfile[0]
+        jname = os.path.splitext(os.path.basename(fname))[0]
+        size, sr = matfile_info(fname)
+        jobs = sample_block_jobs(jname, fname, size, sr,
+                                 {'is_matfile': True,
+                                  'overlap': overlap * 512,
+                                  'destination': destination,
+                                  'h5_layout': args.h5_layout,
+                                  'scale_factor': args.matfile_scale_factor})
+        if args.resume:
+            jobs = skip_finished(jobs)
+        mp_extract(jobs, nWorkers, args.max_pending_mb, args.savers,
+                   args.prefetch)
         return
 
 
+    # binary files are read record-wise like ncs files
+    if (args.binary is not None) or (args.nsx is not None):
+        if args.nsx is not None:
+            fname = args.nsx[0]
+            layout, scales, labels = nsx_layout(fname)
+        else:
+            if args.binary_channels is None:
+                print('Specify the number of channels of the binary file')
+                return
+            fname = args.binary[0]
+            layout = {'n_channels': args.binary_channels,
+                      'sr': args.binary_sr,
+                      'header_bytes': args.binary_header_bytes}
+            scales = [args.binary_scale] * args.binary_channels
+            labels = ['ch{:03d}'.format(i + 1)
+                      for i in range(args.binary_channels)]
+
+        jobs = binary_jobs(fname, layout, scales, labels, args,
+                           {'overlap': overlap,
+                            'destination': destination,
+                            'h5_layout': args.h5_layout})
+        if args.resume:
+            jobs = skip_finished(jobs)
+        mp_extract(jobs, nWorkers, args.max_pending_mb, args.savers,
+                   args.prefetch)
+        return
+
     if args.jobs:
         with open(args.jobs[0], 'r') as f:
             files = [a.strip() for a in f.readlines()]
@@ -88,24 +346,18 @@ def main():
     if args.h5:
         jobs = []
         for f in files:
-            size = get_h5size(f)
-            starts = list(range(0, size, 32000*5*60))
-            stops = starts[1:] + [size]
+            size, sr = get_h5size(f)
             name = os.path.splitext(os.path.basename(f))[0]
-
-            for i in range(len(starts)):
-
-                jdict = {'name': name,
-                     'filename': f,
-                     'start': starts[i],
-                     'stop': stops[i],
-                     'is_h5file': True,
-                     'count': i,
-                     'destination': destination}
-
-                jobs.append(jdict)
-
-        mp_extract(jobs, nWorkers)
+            jobs += sample_block_jobs(name, f, size, sr,
+                                      {'is_h5file': True,
+                                       'overlap': overlap * 512,
+                                       'destination': destination,
+                                       'h5_layout': args.h5_layout})
+
+        if args.resume:
+            jobs = skip_finished(jobs)
+        mp_extract(jobs, nWorkers, args.max_pending_mb, args.savers,
+                   args.prefetch)
         return
 
 
@@ -123,24 +375,8 @@ def main():
         references = {line[0]: line[1] for line in reader}
 
     for f in files:
-        if args.start:
-            start = args.start
-        else:
-            start = 0
-
-        nrecs = get_nrecs(f)
-        if args.stop:
-            stop = min(args.stop, nrecs)
-        else:
-            stop = nrecs
-
-        if stop % blocksize > blocksize/2:
-            laststart = stop-blocksize
-        else:
-            laststart = stop
-
-        starts = list(range(start, laststart, blocksize))
-        stops = starts[1:] + [stop]
+        starts, stops = record_blocks(get_nrecs(f), args.start, args.stop,
+                                      blocksize)
         name = os.path.splitext(os.path.basename(f))[0]
         if references is not None:
             reference = references[f]
@@ -156,10 +392,16 @@ def main():
                      'start': starts[i],
                      'stop': stops[i],
                      'count': i,
+                     'blocksize': blocksize,
+                     'overlap': overlap,
                      'destination': destination,
+                     'h5_layout': args.h5_layout,
                      'reference': reference}
 
             jobs.append(jdict)
 
 
-    mp_extract(jobs, nWorkers)
+    if args.resume:
+        jobs = skip_finished(jobs)
+    mp_extract(jobs, nWorkers, args.max_pending_mb, args.savers,
+               args.prefetch)
@@ -1,5 +1,6 @@
 import numpy as np
-from .interpolate import clean, upsample, downsample, align
+from .interpolate import SpikeInterpolator
+from . import kernels
 
 options = dict([('threshold_factor', 5),        # 5
                 ('max_spike_duration', 0.0015), # 0.0015 (seconds)
@@ -7,7 +8,12 @@ options = dict([('threshold_factor', 5),        # 5
                 ('index_maximum', 19),          # 19
                 ('upsampling_factor', 3),       # 3
                 ('denoise', True),
-                ('do_filter', True)
+                ('do_filter', True),
+                ('interpolation', 'cubic'),     # 'cubic' or 'fft'
+                ('use_float32', False),
+                ('noise_subsample', 1),         # use every n-th sample
+                ('threshold_window', None),     # seconds, None: per block
+                ('use_numba', False)            # compiled kernels
             ])
 
 try:
@@ -17,114 +23,258 @@ try:
 except ImportError:
     pass
 
-def extract_spikes(data, times, timestep, filt):
+if options['use_numba'] and not kernels.HAVE_NUMBA:
+    print('Option use_numba is set, but numba is not installed')
 
-    factor = options['upsampling_factor']
-    indices_per_spike = options['indices_per_spike']
-    pre_indices = options['index_maximum']
-    denoise = options['denoise']
-    post_indices = indices_per_spike - pre_indices
+# interpolators keep their buffers between blocks
+interpolators = {}
 
-    result = []
 
-    if denoise:
-        data = filt.filter_denoise(data)
+def get_interpolator(num_vpe, factor, center, num_points):
+    """
+    returns a cached interpolator for the current options
+    """
+    dtype = np.float32 if options['use_float32'] else np.float64
+    key = (num_vpe, factor, center, num_points,
+           options['interpolation'], dtype)
+    if key not in interpolators:
+        interpolators[key] = SpikeInterpolator(num_vpe, factor, center,
+                                               num_points,
+                                               options['interpolation'],
+                                               dtype)
+    return interpolators[key]
 
-    if options['do_filter']:
-        data_detect = filt.filter_detect(data)
-    else:
-        data_detect = data
 
-    data_extract = None
+def noise_level(data, step=1):
+    """
+    estimates the noise standard deviation along the last axis
+    from the median absolute value of the filtered data.
+    With step larger than 1, the median is computed on a subsample
+    """
+    if step > 1:
+        data = data[..., ::step]
+    return np.median(np.abs(data), axis=-1) / .6745
 
-    noise_level = np.median(np.abs(data_detect)) / .6745
-    threshold = options['threshold_factor'] * noise_level
-    
-    # find over-threshold indices and extract spikes
-    over_threshold = data_detect > threshold
-    under_threshold = data_detect < -threshold
 
-    # do pos and neg
-    borders = [0, 0]
-    length_okay = [0, 0]
-    num_spikes = [0, 0]
-    maxima = [0, 0]
+def block_thresholds(data, times, timestep, core, params):
+    """
+    data has one channel per row. Returns the thresholds,
+    which can be compared to data, and the rows for the 'thr' table
+    of each channel. If params['threshold_window'] is set,
+    one threshold is estimated for each window of the core,
+    and each channel has one threshold per sample.
+    Otherwise, a single threshold is estimated from the whole block.
+    """
+    factor = params['threshold_factor']
+    window = params['threshold_window']
+    step = params['noise_subsample']
 
-    borders[0] = np.diff(over_threshold).nonzero()[0]
-    borders[1] = np.diff(under_threshold).nonzero()[0]
+    if window is None:
+        levels = factor * noise_level(data, step)
+        rows = [[(times[core[0]], times[core[1] - 1], level)]
+                for level in levels]
+        return levels[:, np.newaxis], rows
 
-    for i in (0, 1):
-        if borders[i].shape[0] % 2:
-            borders[i] = borders[i][:-1]
+    n_window = max(1, int(round(window / timestep)))
+    edges = list(range(core[0], core[1], n_window)) + [core[1]]
+    # a short last window is joined to the one before
+    if len(edges) > 2 and edges[-1] - edges[-2] < n_window / 2:
+        del edges[-2]
 
-    # 0 is pos, 1 is neg
-    for i in [0, 1]:
-        borders[i] = borders[i].reshape(-1,2)
-        length_okay[i] = (borders[i][:,1] - borders[i][:,0]) <= \
-                         options['max_spike_duration'] / timestep
-        num_spikes[i] = len(length_okay[i])
+    levels = np.array([factor * noise_level(data[:, start:stop], step)
+                       for start, stop in zip(edges[:-1], edges[1:])]).T
+    rows = [[(times[start], times[stop - 1], level) for start, stop, level
+             in zip(edges[:-1], edges[1:], channel_levels)]
+            for channel_levels in levels]
+
+    # context outside of the core uses the thresholds of the border windows
+    edges[0] = 0
+    edges[-1] = data.shape[1]
+    thresholds = np.repeat(levels, np.diff(edges), axis=1).astype(data.dtype)
+
+    return thresholds, rows
 
 
+def threshold_borders(data, thresholds):
+    """
+    data has one channel per row. Returns, for each channel,
+    the start and stop indices of positive and negative
+    threshold crossings as two arrays of shape (n, 2)
+    """
+    n_channels = data.shape[0]
+    ret = [[None, None] for _ in range(n_channels)]
+
+    for sign, over in enumerate((data > thresholds, data < -thresholds)):
+        rows, cols = np.diff(over, axis=1).nonzero()
+        splits = np.searchsorted(rows, np.arange(1, n_channels))
+        for i, borders in enumerate(np.split(cols, splits)):
+            # a block that starts over threshold has no first crossing
+            if over[i, 0]:
+                borders = borders[1:]
+            if borders.shape[0] % 2:
+                borders = borders[:-1]
+            ret[i][sign] = borders.reshape(-1, 2)
+
+    return ret
+
+
+def find_maxima(data, borders, sign):
+    """
+    returns the index of the extremum of data in each of the ranges
+    borders[i, 0] to borders[i, 1] (exclusive), maxima for sign 0
+    and minima for sign 1
+    """
+    if borders.shape[0] == 0:
+        return np.zeros(0, dtype=int)
+
+    lengths = borders[:, 1] - borders[:, 0]
+    offsets = np.arange(lengths.max())
+    # shorter ranges repeat their last index, which does not
+    # change the position of the first extremum
+    index = np.minimum(borders[:, 0:1] + offsets,
+                       borders[:, 0:1] + lengths[:, np.newaxis] - 1)
+    if sign == 1:
+        pos = data[index].argmin(1)
+    else:
+        pos = data[index].argmax(1)
+
+    return borders[:, 0] + pos
+
+
+def gather_windows(data, maxima, pre, post):
+    """
+    returns a matrix that contains, for each maximum,
+    data from maximum - pre to maximum + post (exclusive)
+    """
+    index = maxima[:, np.newaxis] + np.arange(-pre, post)
+    return data[index]
+
+
+def channel_maxima(data_detect, borders, max_length):
+    """
+    returns the extrema of positive and negative threshold crossings
+    that are not longer than max_length samples
+    """
+    ret = []
     for sign in [0, 1]:
-        if num_spikes[sign] == 0:
-            result.append((np.zeros((0, indices_per_spike)), np.zeros(0)))
-            continue
+        sign_borders = borders[sign]
+        length_okay = (sign_borders[:, 1] - sign_borders[:, 0]) <= max_length
+        ret.append(find_maxima(data_detect, sign_borders[length_okay], sign))
+    return ret
 
-        borders[sign] = borders[sign][length_okay[sign]]
 
-        if sign == 1:
-            detect_func = np.argmin
+def channel_spikes(data_extract, times, all_maxima, core, params):
+    """
+    extracts positive and negative spikes from one
+    filtered channel, given the extrema of its threshold crossings
+    """
+    factor = params['upsampling_factor']
+    indices_per_spike = params['indices_per_spike']
+    pre_indices = params['index_maximum']
+    post_indices = indices_per_spike - pre_indices
+
+    result = []
+
+    # 0 is pos, 1 is neg
+    for sign in [0, 1]:
+        maxima = all_maxima[sign]
+
+        if core is not None:
+            maxima = maxima[(maxima >= core[0]) & (maxima < core[1])]
+        elif len(maxima) > 3:
+            maxima = maxima[1:-2]
         else:
-            detect_func = np.argmax
-        maxima = [detect_func(data_detect[range(borders[sign][i,0],
-                                borders[sign][i,1])])
-                        + borders[sign][i,0]
-                        for i in range(borders[sign].shape[0])]
+            maxima = np.zeros(0, dtype=int)
 
-        if len(maxima) <= 3:
+        if len(maxima) == 0:
             result.append((np.zeros((0, indices_per_spike)), np.zeros(0)))
             continue
 
-        maxima = np.array(maxima[1:-2])
         print((np.diff(maxima) < 64).sum())
         # make sure maxima are far enough from border of data
-        mindex = (maxima >= pre_indices + 5) & (maxima <= len(data) - post_indices - 5)
+        mindex = (maxima >= pre_indices + 5) &\
+            (maxima <= len(data_extract) - post_indices - 5)
         print('Shortening maxima list from {} to {}'.format(len(maxima), mindex.sum()))
         maxima = maxima[mindex]
-        if data_extract is None:
-            if options['do_filter']:
-                data_extract = filt.filter_extract(data)
-            else:
-                data_extract = data
-
-        extract_indices = [
-            range(maxima[i] - pre_indices - 5, maxima[i] + post_indices + 5)
-            for i in range(len(maxima))]
-
-        spikes = np.zeros((len(extract_indices), indices_per_spike + 10))
+        if len(maxima) == 0:
+            result.append((np.zeros((0, indices_per_spike)), np.zeros(0)))
+            continue
 
-        for i, spike in enumerate(extract_indices):
-            spikes[i] = data_extract[extract_indices[i]]
+        spikes = gather_windows(data_extract, maxima,
+                                pre_indices + 5, post_indices + 5)
 
         if sign == 1:
             spikes *= -1
 
-        spikes = upsample(spikes, factor)
-
-        spikes, index_maximum = align(spikes,
-                                  (pre_indices + 5) * factor,
-                                  factor,
-                                  factor)
-        _, removed_indices = clean(spikes, index_maximum)
+        # upsample, align, and downsample
+        interpolator = get_interpolator(spikes.shape[1], factor,
+                                        (pre_indices + 5) * factor,
+                                        indices_per_spike)
+        spikes, _ = interpolator.process(spikes)
 
         # this is not optimal, but the error is less than .5 ms in use cases
         timestamps = times[maxima]
-        spikes, new_length = downsample(spikes, index_maximum, factor, pre_indices, indices_per_spike)
 
         if sign == 1:
             spikes *= -1
 
         result.append((spikes, timestamps))
-    result.append([(times[0], times[-1], threshold)])
 
     return result
+
+
+def extract_spikes_batch(data, times, timestep, filt, core=None):
+    """
+    detect and extract spikes from one block of several channels
+    recorded together, e.g. a tetrode or a bundle of microwires.
+    data has shape (n_channels, n_samples), times are shared by
+    all channels. All channels are filtered and thresholded together.
+    Returns one result per channel, as returned by extract_spikes
+    """
+    params = dict(options)
+
+    if params['do_filter']:
+        data_detect, data_extract = filt.filter_chain(data, params['denoise'])
+    else:
+        if params['denoise']:
+            data = filt.filter_denoise(data)
+        data_detect = data_extract = data
+
+    if core is None:
+        thr_core = (0, data.shape[1])
+    else:
+        thr_core = core
+
+    thresholds, threshold_rows = block_thresholds(data_detect, times,
+                                                  timestep, thr_core, params)
+    max_length = params['max_spike_duration'] / timestep
+
+    use_kernels = params['use_numba'] and kernels.HAVE_NUMBA
+    if not use_kernels:
+        borders = threshold_borders(data_detect, thresholds)
+
+    ret = []
+    for i in range(data.shape[0]):
+        if use_kernels:
+            maxima = [kernels.detect_maxima(data_detect[i], thresholds[i],
+                                            sign, max_length)
+                      for sign in [0, 1]]
+        else:
+            maxima = channel_maxima(data_detect[i], borders[i], max_length)
+        result = channel_spikes(data_extract[i], times, maxima, core, params)
+        result.append(threshold_rows[i])
+        ret.append(result)
+
+    return ret
+
+
+def extract_spikes(data, times, timestep, filt, core=None):
+    """
+    detect and extract spikes from one block of data.
+    core is an optional (start, stop) pair of sample indices:
+    if given, data outside of core is only used as filter
+    and border context from neighboring blocks, and only spikes
+    with maximum inside of core are returned
+    """
+    return extract_spikes_batch(np.asarray(data)[np.newaxis], times,
+                                timestep, filt, core)[0]
@@ -1,5 +1,6 @@
-from numpy import zeros, arange
+from numpy import zeros, arange, empty, eye, dot, float64, finfo, abs as np_abs
 from scipy.interpolate import make_interp_spline
+from scipy.signal import resample
 
 
 def upsample(data, factor):
@@ -53,3 +54,53 @@ def downsample(data, old_center, skip, new_center=19, num_points=64):
 #    index = (arange(num_points) - new_center) * skip + old_center
     index = arange(num_points) * skip
     return data[:,index], num_points
+
+
+class SpikeInterpolator(object):
+    """
+    upsample, align and downsample a whole matrix of spikes in one pass.
+    Cubic spline and FFT interpolation are linear in the data,
+    so upsampling is a single matrix product into a buffer
+    that is re-used for all subsequent calls.
+    The result is the same as that of upsample, align, and downsample.
+    """
+    def __init__(self, num_vpe, factor, center, num_points=64,
+                 method='cubic', dtype=float64):
+        up_num_vpe = (num_vpe - 1) * factor + 1
+        if method == 'cubic':
+            axis = arange(0, up_num_vpe, factor)
+            matrix = make_interp_spline(axis, eye(num_vpe))(arange(up_num_vpe))
+        elif method == 'fft':
+            matrix = resample(eye(num_vpe), num_vpe * factor)[:up_num_vpe]
+        else:
+            raise ValueError('Unknown interpolation method: ' + method)
+
+        # avoid underflow when casting to single precision
+        matrix[np_abs(matrix) < finfo(dtype).tiny] = 0
+        self.matrix = matrix.T.astype(dtype)
+        self.dtype = dtype
+        self.factor = factor
+        self.width = 5
+        self.center = center
+        self.num_points = num_points
+        self.buffer = empty((0, up_num_vpe), dtype)
+
+    def process(self, data):
+        """
+        returns downsampled, aligned spikes and index of maximum
+        """
+        num_e = data.shape[0]
+        if self.buffer.shape[0] < num_e:
+            self.buffer = empty((num_e, self.matrix.shape[1]), self.dtype)
+        up_data = self.buffer[:num_e]
+        dot(data.astype(self.dtype, copy=False), self.matrix, out=up_data)
+
+        shift = self.width * self.factor
+        index_max = up_data[:, self.center - shift:self.center + shift]\
+            .argmax(1) + self.center - shift
+        # align and downsample in one step
+        index = index_max[:, None] - self.center + shift +\
+            arange(self.num_points) * self.factor
+
+        return (up_data[arange(num_e)[:, None], index],
+                self.center - shift)
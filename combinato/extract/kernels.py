@@ -0,0 +1,120 @@
+# 2026-10-18
+"""
+Optional compiled kernels for spike extraction.
+If numba is not installed, HAVE_NUMBA is False and
+extract_spikes uses its NumPy code instead.
+"""
+from __future__ import division, print_function, absolute_import
+import numpy as np
+
+try:
+    from numba import njit
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+    def njit(*args, **kwargs):
+        """
+        replacement decorator, kernels remain plain Python functions
+        """
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+
+@njit(cache=True)
+def detect_maxima(data, thresholds, sign, max_length):
+    """
+    a single pass over data that finds threshold crossings
+    and the position of the extremum in each crossing.
+    thresholds has one value, or one value per sample.
+    Sign 0 looks for maxima above thresholds,
+    sign 1 for minima below -thresholds.
+    The result is the same as that of threshold_borders,
+    the length check, and find_maxima in extract_spikes:
+    each range starts at the last sample below threshold and ends
+    before the last sample above threshold, crossings that are
+    not complete inside of data are ignored.
+    """
+    n_samples = data.shape[0]
+    per_sample = thresholds.shape[0] > 1
+    out = np.empty(n_samples // 2 + 1, np.int64)
+    n_out = 0
+
+    thr = thresholds[0]
+    if sign == 0:
+        prev = data[0] > thr
+    else:
+        prev = data[0] < -thr
+
+    start = -1
+    best = -1
+    for i in range(1, n_samples):
+        if per_sample:
+            thr = thresholds[i]
+        if sign == 0:
+            cur = data[i] > thr
+        else:
+            cur = data[i] < -thr
+
+        if start >= 0:
+            if cur:
+                if sign == 0:
+                    if data[i - 1] > data[best]:
+                        best = i - 1
+                elif data[i - 1] < data[best]:
+                    best = i - 1
+            else:
+                if i - 1 - start <= max_length:
+                    out[n_out] = best
+                    n_out += 1
+                start = -1
+        elif cur and not prev:
+            start = i - 1
+            best = i - 1
+
+        prev = cur
+
+    return out[:n_out]
+
+
+def test():
+    """
+    compares the kernels to the NumPy code in extract_spikes
+    """
+    from .extract_spikes import threshold_borders, find_maxima
+
+    print('Testing kernels, numba installed: {}'.format(HAVE_NUMBA))
+    rng = np.random.RandomState(0)
+    n_samples = 20000
+    max_length = 12.
+
+    for dtype in (np.float64, np.float32):
+        for smooth in (1, 4, 16):
+            data = np.convolve(rng.randn(n_samples), np.ones(smooth),
+                               'same').astype(dtype)[np.newaxis]
+            # start and end the block in a crossing
+            data[0, :3] = 10
+            data[0, -3:] = -10
+            level = 2 * data.std()
+            for thresholds in (np.array([[level]]),
+                               level * (1 + .5 * np.sin(
+                                   np.arange(n_samples) / 500.))
+                               [np.newaxis].astype(dtype)):
+                borders = threshold_borders(data, thresholds)[0]
+                for sign in (0, 1):
+                    sign_borders = borders[sign]
+                    length_okay = (sign_borders[:, 1] -
+                                   sign_borders[:, 0]) <= max_length
+                    expected = find_maxima(data[0],
+                                           sign_borders[length_okay], sign)
+                    found = detect_maxima(data[0], thresholds[0],
+                                          sign, max_length)
+                    assert (expected == found).all(),\
+                        'Mismatch for {} {} {}'.format(dtype, smooth, sign)
+
+    print('Kernels and NumPy code agree')
+
+
+if __name__ == '__main__':
+    test()
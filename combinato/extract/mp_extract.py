@@ -1,71 +1,195 @@
 # JN 2015-02-13 refactoring
 from __future__ import absolute_import, print_function, division
 
-from collections import defaultdict
-from multiprocessing import Process, Queue, Value
+import sys
+import time
+from collections import defaultdict, deque
+from multiprocessing import Process, Queue, Value, Semaphore, RawArray
+from multiprocessing.pool import ThreadPool
 import numpy as np
 
 np.seterr(all='raise')
 
+try:
+    import resource
+except ImportError:
+    resource = None
+
 import tables
-from .. import DefaultFilter
-from .tools import ExtractNcsFile, OutFile, read_matfile
-from .extract_spikes import extract_spikes
+from .. import DefaultFilter, NcsFile
+from .tools import open_reader, OutFile, MatFile, sample_times,\
+    h5_sampling_rate, read_bundle, checkpoint_block, SAMPLES_PER_REC
+from .extract_spikes import extract_spikes, extract_spikes_batch, options
+
+# memory for blocks that are read, but not yet saved
+MAX_PENDING_MB = 2000
+# blocks of ncs files that are read ahead by reader threads
+PREFETCH_BLOCKS = 2
+
+
+def peak_memory_mb():
+    """
+    returns the peak resident memory of this process in MB,
+    or None where the resource module is not available
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on OS X, in kilobytes elsewhere
+    if sys.platform == 'darwin':
+        peak /= 1024
+    return peak / 1024
+
+
+def print_exit(name):
+    """
+    report the end of a process and its peak memory
+    """
+    peak = peak_memory_mb()
+    if peak is None:
+        print(name + ' exited')
+    else:
+        print('{} exited, peak memory {:.0f} MB'.format(name, peak))
+
 
+class BlockSlots(object):
+    """
+    pool of shared memory buffers for float32 data blocks.
+    Only the slot index is passed between processes,
+    so the data need not be pickled.
+    """
+    def __init__(self, n_slots, slot_len):
+        self.buffers = [RawArray('f', slot_len) for _ in range(n_slots)]
+        self.free = Queue()
+        for i in range(n_slots):
+            self.free.put(i)
+
+    def acquire(self):
+        """
+        index of a free slot, blocks until a slot is free
+        """
+        return self.free.get()
+
+    def get(self, i, shape):
+        """
+        view of shape into the data of slot i
+        """
+        return np.frombuffer(self.buffers[i], np.float32,
+                             int(np.prod(shape))).reshape(shape)
+
+    def release(self, i):
+        """
+        mark slot i as free
+        """
+        self.free.put(i)
+
+
+def result_nbytes(result):
+    """
+    memory used by the spikes and times in a result
+    """
+    return sum(spikes.nbytes + times.nbytes for spikes, times in result[:2])
 
-def save(q, ctarget):
 
+def per_second(num, seconds):
+    """
+    rate for the throughput report, safe for zero durations
+    """
+    return num / seconds if seconds > 0 else float('inf')
+
+
+def save(q, ctarget, tickets=None, start_time=None):
+    """
+    reads results from q and writes them in the correct order.
+    Results that arrive before their predecessor are held back.
+    After writing a result, its ticket is released,
+    so that the reader can start a new block.
+    """
     openfiles = {}
     saved = 0
     pending_jobs = defaultdict(dict)
-    last_saved_count = defaultdict(lambda : -1)
-    all_data = []
+    pending_bytes = 0
+    last_saved_count = {}
+    # throughput statistics per channel, measured from the start
+    # of mp_extract so that the numbers of all channels are comparable
+    if start_time is None:
+        start_time = time.time()
+    nsamples = defaultdict(int)
+    worktime = defaultdict(float)
 
     while saved < ctarget:
-        inp = q.get()
-
-        job = inp[0]
-        datatuple = inp[1]
-        ind = len(all_data)
-
-        all_data.append(datatuple)
-        job.update(all_data_ind=ind)
+        job, datatuple = q.get()
 
         jname = job['name']
         this_name_pending_jobs = pending_jobs[jname]
 
-        jcount = job['count']
-        this_name_pending_jobs[jcount] = job
+        if jname not in last_saved_count:
+            # resumed jobs continue after the checkpoint
+            last_saved_count[jname] = job.get('resume_count', -1)
 
+        jcount = job['count']
+        this_name_pending_jobs[jcount] = (job, datatuple)
+        pending_bytes += result_nbytes(datatuple)
+        del datatuple
 
-        print('Job name: {} pending jobs: {} jnow: {}'.format(jname,
-                                                              this_name_pending_jobs.keys(),
-                                                              jcount))
+        print('Job name: {} pending jobs: {} jnow: {} pending MB: {:.1f}'.
+              format(jname, sorted(this_name_pending_jobs.keys()), jcount,
+                     pending_bytes/2**20))
 
         while last_saved_count[jname] + 1 in this_name_pending_jobs:
-            sjob = this_name_pending_jobs[last_saved_count[jname] + 1]
-            data = all_data[sjob['all_data_ind']]
+            sjob, data = this_name_pending_jobs.pop(last_saved_count[jname] + 1)
             if not sjob['name'] in openfiles:
 
                  spoints = data[0][0].shape[1]
                  openfiles[sjob['name']] = OutFile(sjob['name'], sjob['filename'],
-                                                   spoints, sjob['destination'])
+                                                   spoints, sjob['destination'],
+                                                   sjob.get('h5_layout',
+                                                            'default'),
+                                                   'resume_count' in sjob)
 
             print('saving {}, count {}'.format(sjob['name'], sjob['count']))
-            openfiles[sjob['name']].write(data)
-            all_data[sjob['all_data_ind']] = None
+            openfiles[sjob['name']].write(data, sjob['count'],
+                                          checkpoint_block(sjob))
+            pending_bytes -= result_nbytes(data)
+            # release the result immediately
+            del data
+            if tickets is not None:
+                tickets.release()
             last_saved_count[jname] = sjob['count']
-            del this_name_pending_jobs[sjob['count']]
             saved += 1
-
+            nsamples[jname] += sjob['nsamples']
+            worktime[jname] += sjob['worktime']
 
     for fid in openfiles.values():
         fid.close()
 
-    print('Save exited')
+    walltime = time.time() - start_time
+    for jname in sorted(nsamples):
+        print('{}: {} samples, {:.0f} samples/s, {:.0f} samples/s per worker'.
+              format(jname, nsamples[jname],
+                     per_second(nsamples[jname], walltime),
+                     per_second(nsamples[jname], worktime[jname])))
+
+    print_exit('Save')
 
 
-def work(q_in, q_out, count, target):
+def shared_times(times):
+    """
+    True if the channels of a block have the same timestamps
+    """
+    first = times[0]
+    return all(np.array_equal(first.starts, other.starts) and
+               first.step == other.step for other in times[1:])
+
+
+def work(q_in, q_out, count, target, slots=None):
+    """
+    extracts spikes from the blocks in q_in. Each block holds
+    the channels of a read group, shape (n_channels, n_samples).
+    Channels with common timestamps are filtered and thresholded
+    together by extract_spikes_batch.
+    One result per channel is put into the queue of its saver
+    """
 
     filters = {}
 
@@ -73,109 +197,379 @@ def work(q_in, q_out, count, target):
         with count.get_lock():
             count.value += 1
 
-        inp = q_in.get()
-        job = inp[0]
-        datatuple = inp[1]
-        ts = datatuple[2]
+        jobs, datatuple, slot = q_in.get()
+        data, times, ts = datatuple
+
+        if slot is not None:
+            # data are in shared memory
+            data = slots.get(*slot)
 
         if not ts in filters:
-            filters[ts] = DefaultFilter(ts)
+            if options['use_float32']:
+                filters[ts] = DefaultFilter(ts, np.float32)
+            else:
+                filters[ts] = DefaultFilter(ts)
 
         filt = filters[ts]
+        core = jobs[0].get('core')
 
-        result = extract_spikes(datatuple[0],
-                                datatuple[1],
-                                ts,  filt)
+        t1 = time.time()
+        if shared_times(times):
+            results = extract_spikes_batch(data, times[0], ts, filt, core)
+        else:
+            results = [extract_spikes(data[i], times[i], ts, filt, core)
+                       for i in range(len(jobs))]
+        worktime = (time.time() - t1) / len(jobs)
+        del data, datatuple
+        if slot is not None:
+            slots.release(slot[0])
 
-        q_out.put((job, result))
+        for job, result in zip(jobs, results):
+            job.update(worktime=worktime)
+            q_out[job['saver']].put((job, result))
 
-    print('Work exited')
+    print_exit('Work')
 
 
-def read(jobs, q):
+def block_with_overlap(job, size):
     """
-    writes to q; q is read by worker processes
+    extend the block of a job by job['overlap'] on both sides,
+    as far as the data reach
     """
-    openfiles = {}
+    overlap = job.get('overlap', 0)
+    return max(0, job['start'] - overlap), min(size, job['stop'] + overlap)
 
-    for job in jobs:
-        jname = job['name']
 
-        if ('is_h5file' in job.keys()) and job['is_h5file']:
-            if jname not in openfiles:
-                openfiles[jname] = tables.open_file(job['filename'], 'r')
+def same_block(job1, job2):
+    """
+    True if both jobs read the same block of ncs files
+    with the same reference
+    """
+    return (not is_h5_or_matfile(job1)) and (not is_h5_or_matfile(job2)) and\
+        job1['reference'] is not None and\
+        job1['reference'] == job2['reference'] and\
+        job1['start'] == job2['start'] and job1['stop'] == job2['stop']
 
-            if openfiles[jname].root.data.ndim == 1:
-                fdata = openfiles[jname].root.data[job['start']:job['stop']]
-            else:
-                raise Warning('Data has wrong number of dimensions')
-            fdata = fdata.ravel()
-            if 'sr' in openfiles[jname].root.__members__:
-                sr = openfiles[jname].root.sr[0]
-            else:
-                sr = 32000.
-            ts = 1/sr
-            # here we need to shift the data according to job['start']
-            atimes = np.linspace(0, fdata.shape[0]/(sr/1000), fdata.shape[0])
-            atimes += job['start']/(sr/1000)
-            data = (fdata, atimes, ts)
- 
-            job.update(filename='data_' + jname + '.h5')
-
-
-        elif 'is_matfile' in job.keys():
-            if job['is_matfile']:
-                fname = job['filename']
-                print('Reading from matfile ' + fname)
-                data = read_matfile(fname)
-                if job['scale_factor'] != 1:
-                    print('Rescaling matfile data by {:.4f}'.
-                        format(job['scale_factor']))
-                    data = (data[0] * job['scale_factor'],
-                            data[1],
-                            data[2])
-                job.update(filename='data_' + jname + '.h5')
 
+def read_groups(jobs):
+    """
+    split jobs into groups that are read together:
+    consecutive jobs that read the same block of channels
+    with a common reference form one group
+    """
+    groups = []
+    i_job = 0
+    while i_job < len(jobs):
+        group = [jobs[i_job]]
+        while i_job + len(group) < len(jobs) and\
+                same_block(jobs[i_job], jobs[i_job + len(group)]):
+            group.append(jobs[i_job + len(group)])
+        groups.append(group)
+        i_job += len(group)
+    return groups
+
+
+def read_h5_or_matfile(job, openfiles):
+    """
+    read the block of a job from an h5 file or a matfile
+    """
+    jname = job['name']
+
+    if ('is_h5file' in job.keys()) and job['is_h5file']:
+        if jname not in openfiles:
+            openfiles[jname] = tables.open_file(job['filename'], 'r')
+
+        rstart, rstop = block_with_overlap(job,
+                                           openfiles[jname].root.data.shape[0])
+        if openfiles[jname].root.data.ndim == 1:
+            fdata = openfiles[jname].root.data[rstart:rstop]
         else:
-            if jname not in openfiles:
-                openfiles[jname] = ExtractNcsFile(job['filename'], job['reference'])
+            raise Warning('Data has wrong number of dimensions')
+        fdata = fdata.ravel()
+        sr = h5_sampling_rate(openfiles[jname])
+        # here we need to shift the data according to rstart
+        data = (fdata, sample_times(rstart, fdata.shape[0], sr), 1/sr)
+
+    else:
+        if jname not in openfiles:
+            print('Reading from matfile ' + job['filename'])
+            openfiles[jname] = MatFile(job['filename'])
+            if job['scale_factor'] != 1:
+                print('Rescaling matfile data by {:.4f}'.
+                      format(job['scale_factor']))
+
+        rstart, rstop = block_with_overlap(job, openfiles[jname].num_samples)
+        data = openfiles[jname].read(rstart, rstop)
+        if job['scale_factor'] != 1:
+            data = (data[0] * job['scale_factor'],
+                    data[1],
+                    data[2])
+
+    job.update(filename='data_' + jname + '.h5',
+               core=(job['start'] - rstart, job['stop'] - rstart),
+               nsamples=job['stop'] - job['start'])
+
+    return (data[0][np.newaxis], [data[1]], data[2])
+
+
+def group_block(group, readers, ref_file):
+    """
+    first and last record of the block of a group,
+    including the overlap
+    """
+    num_recs = min([reader.num_recs for reader in readers])
+    if ref_file is not None:
+        num_recs = min(num_recs, ref_file.num_recs)
+    return block_with_overlap(group[0], num_recs)
 
-            print('Read {} {: 7d} {: 7d}'.format(jname, job['start'], job['stop']))
-            data = openfiles[jname].read(job['start'], job['stop'])
-            job.update(filename='data_' + jname + '.h5')
 
-        q.put((job, data))
+def read_group(group, readers, ref_file, out=None):
+    """
+    read the block of a group of ncs or binary file jobs,
+    returns the group and its data, an (n_channels, n_samples) array,
+    the timestamps of each channel, and the timestep.
+    If out is given, data are read into it.
+    Called from the prefetching threads
+    """
+    job = group[0]
+    rstart, rstop = group_block(group, readers, ref_file)
 
-    print('Read exited')
+    print('Read {} {: 7d} {: 7d}'.format(
+        ', '.join(gjob['name'] for gjob in group),
+        job['start'], job['stop']))
+    data = read_bundle(readers, ref_file, rstart, rstop, out)
 
+    for gjob in group:
+        gjob.update(filename='data_' + gjob['name'] + '.h5',
+                    core=((job['start'] - rstart) * SAMPLES_PER_REC,
+                          (job['stop'] - rstart) * SAMPLES_PER_REC),
+                    nsamples=(job['stop'] - job['start']) * SAMPLES_PER_REC)
 
-def mp_extract(jobs, nWorkers):
+    return group, data
 
-    procs = []
 
-    ctarget = len(jobs)
+def read(jobs, q, tickets=None, slots=None, prefetch=PREFETCH_BLOCKS):
+    """
+    writes to q; q is read by worker processes.
+    A ticket is needed for each block, tickets are
+    released by the saver once the block is written.
+    If slots are given, ncs data are read directly into shared memory.
+    Consecutive jobs that read the same block of channels
+    with a common reference are read together,
+    and the reference is read only once for them.
+    Up to prefetch blocks of ncs files are read ahead
+    by a pool of threads, after a hint to the operating system.
+    """
+    openfiles = {}
+    openrefs = {}
+
+    def put(group, data, slot=None):
+        if tickets is not None:
+            for _ in group:
+                tickets.acquire()
+        if slot is not None:
+            # the worker finds the data in the slot
+            data = (None, data[1], data[2])
+        q.put((group, data, slot))
+
+    def put_next():
+        result, slot = pending.popleft()
+        put(*result.get(), slot=slot)
+
+    pool = ThreadPool(prefetch) if prefetch > 0 else None
+    pending = deque()
+
+    for group in read_groups(jobs):
+        job = group[0]
+
+        if is_h5_or_matfile(job):
+            # h5 files are not read from threads, keep the job order
+            while len(pending):
+                put_next()
+            put(group, read_h5_or_matfile(job, openfiles))
+            continue
+
+        for gjob in group:
+            if gjob['name'] not in openfiles:
+                openfiles[gjob['name']] = open_reader(gjob)
+        readers = [openfiles[gjob['name']] for gjob in group]
+
+        reference = job['reference']
+        if reference is not None and reference not in openrefs:
+            openrefs[reference] = NcsFile(reference, use_memmap=True)
+        ref_file = openrefs.get(reference)
+
+        rstart, rstop = group_block(group, readers, ref_file)
+        slot = out = None
+        if slots is not None:
+            slot = (slots.acquire(),
+                    (len(group), (rstop - rstart) * SAMPLES_PER_REC))
+            out = slots.get(*slot)
+
+        if pool is None:
+            put(*read_group(group, readers, ref_file, out), slot=slot)
+            continue
+
+        for reader in readers + [ref_file]:
+            if reader is not None:
+                reader.advise(rstart, rstop)
+
+        pending.append((pool.apply_async(read_group,
+                                         (group, readers, ref_file, out)),
+                        slot))
+        while len(pending) > prefetch:
+            put_next()
+
+    while len(pending):
+        put_next()
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    print_exit('Read')
+
+
+def is_h5_or_matfile(job):
+    """
+    True for jobs that read from h5 files or matfiles
+    """
+    return job.get('is_h5file', False) or job.get('is_matfile', False)
+
+
+def estimate_block_bytes(job):
+    """
+    estimate the memory needed for the raw data of one block
+    (float32 data, timestamps are computed on demand)
+    """
+    if 'start' not in job:
+        return 0
+    nsamples = job['stop'] - job['start'] + 2 * job.get('overlap', 0)
+    if not is_h5_or_matfile(job):
+        nsamples *= SAMPLES_PER_REC
+
+    return nsamples * 4
+
+
+def schedule(jobs, n_savers=1, interleave=1):
+    """
+    order jobs such that the blocks of groups of 'interleave' channels
+    alternate, each channel is still read from start to end.
+    Channels with a common reference form one group,
+    so that each block of the reference is read only once.
+    Channels are assigned to savers in turn.
+    """
+    channels = []
+    by_channel = defaultdict(list)
+    for job in jobs:
+        if job['name'] not in by_channel:
+            channels.append(job['name'])
+        by_channel[job['name']].append(job)
+
+    groups = []
+    by_reference = {}
+    unreferenced = []
+    for name in channels:
+        reference = by_channel[name][0].get('reference')
+        if reference is None or is_h5_or_matfile(by_channel[name][0]):
+            unreferenced.append(name)
+        elif reference in by_reference:
+            by_reference[reference].append(name)
+        else:
+            by_reference[reference] = [name]
+            groups.append(by_reference[reference])
+
+    for i_group in range(0, len(unreferenced), interleave):
+        groups.append(unreferenced[i_group:i_group + interleave])
+
+    ret = []
+    i_channel = 0
+    for group in groups:
+        n_blocks = max(len(by_channel[name]) for name in group)
+        for i_block in range(n_blocks):
+            for i_name, name in enumerate(group):
+                if i_block < len(by_channel[name]):
+                    job = by_channel[name][i_block]
+                    job.update(saver=(i_channel + i_name) % n_savers)
+                    ret.append(job)
+        i_channel += len(group)
+
+    return ret
+
+
+def mp_extract(jobs, nWorkers, max_pending_mb=MAX_PENDING_MB, nSavers=1,
+               prefetch=PREFETCH_BLOCKS):
+    """
+    extract spikes from jobs with nWorkers worker processes
+    and nSavers saver processes (each saver writes its own channels).
+    At most max_pending_mb of blocks are read but not yet saved,
+    in addition to prefetch blocks that are read ahead
+    """
+    procs = []
+    start_time = time.time()
+
+    if not len(jobs):
+        print('Nothing to extract')
+        return
+
+    nSavers = max(1, min(nSavers, len(set(job['name'] for job in jobs))))
+    jobs = schedule(jobs, nSavers, nSavers)
+    # workers extract one read group (a block of one or more channels)
+    # at a time
+    groups = read_groups(jobs)
+    ctarget = len(groups)
+    max_group = max(len(group) for group in groups)
     count = Value('i', 0)
 
+    block_bytes = max([estimate_block_bytes(job) for job in jobs] + [1])
+    # all channels of a group must fit
+    n_tickets = max(max_group, int(max_pending_mb * 2**20 / block_bytes))
+    if n_tickets < nWorkers:
+        print('Warning: only {} blocks fit into {} MB, not all {} workers'
+              ' can be busy'.format(n_tickets, max_pending_mb, nWorkers))
+    tickets = Semaphore(n_tickets)
+
     q_read = Queue(5)
-    q_work = Queue()
+    q_work = [Queue(2 * nWorkers) for _ in range(nSavers)]
+
+    # shared memory for the blocks of ncs jobs
+    ncs_bytes = [estimate_block_bytes(job) for job in jobs
+                 if not is_h5_or_matfile(job)]
+    if len(ncs_bytes):
+        # one slot per group that is being read, prefetched, queued,
+        # or worked on. The reader holds up to prefetch + 1 slots
+        # before it queues a block
+        n_slots = min(n_tickets // max_group, nWorkers + 5 + prefetch + 1)
+        slots = BlockSlots(max(prefetch + 1, n_slots),
+                           max_group * max(ncs_bytes)//4)
+    else:
+        slots = None
 
     # start the reading process
-    p = Process(target=read, args=[jobs, q_read])
+    p = Process(target=read, args=[jobs, q_read, tickets, slots, prefetch])
     p.daemon = True
     p.start()
 
     # start the worker processes
     for i in range(nWorkers):
-        p = Process(target=work, args=[q_read, q_work, count, ctarget])
+        p = Process(target=work, args=[q_read, q_work, count, ctarget,
+                                       slots])
         p.daemon = True
         p.start()
         procs.append(p)
 
-    # start the saver process
-    p = Process(target=save, args=[q_work, ctarget])
-    p.daemon = True
-    p.start()
-    p.join()
+    # start the saver processes
+    savers = []
+    for i in range(nSavers):
+        starget = sum(job['saver'] == i for job in jobs)
+        p = Process(target=save, args=[q_work[i], starget, tickets,
+                                       start_time])
+        p.daemon = True
+        p.start()
+        savers.append(p)
+
+    for p in savers:
+        p.join()
 
     for p in procs:
         p.join()
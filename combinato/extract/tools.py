@@ -4,55 +4,183 @@ reading and writing data
 # pylint: disable=E1101
 from __future__ import absolute_import, print_function, division
 import os
+import json
 import numpy as np
 import tables
 from .. import NcsFile, DefaultFilter
 
-from scipy.io import loadmat
+from scipy.io import loadmat, whosmat
 
 SAMPLES_PER_REC = 512
 DEFAULT_MAT_SR = 24000
+DEFAULT_H5_SR = 32000.
+
+class BlockTimes(object):
+    """
+    timestamps (in milliseconds) of the samples of a block,
+    computed on demand from the start times of records
+    and the step between samples.
+    Index it like the array of all timestamps.
+    """
+    def __init__(self, starts, step, samples_per_rec=SAMPLES_PER_REC):
+        self.starts = np.asarray(starts, dtype=np.float64)
+        self.step = step
+        self.samples_per_rec = samples_per_rec
+
+    def __len__(self):
+        return self.starts.shape[0] * self.samples_per_rec
+
+    def __getitem__(self, index):
+        index = np.asarray(index)
+        index = np.where(index < 0, index + len(self), index)
+        rec, pos = np.divmod(index, self.samples_per_rec)
+        return self.starts[rec] + pos * self.step
+
+
+def sample_times(start, num, sr):
+    """
+    BlockTimes of num samples from sample start on, sampled at sr
+    """
+    return BlockTimes([start/(sr/1000)], 1000/sr, num)
+
+
+def h5_sampling_rate(fid):
+    """
+    sampling rate stored in an open h5 file, or the default
+    """
+    if 'sr' in fid.root.__members__:
+        return fid.root.sr[0]
+    return DEFAULT_H5_SR
+
+
+def matfile_info(fname):
+    """
+    returns the number of samples and the sampling rate of a matfile,
+    without loading the data
+    """
+    if tables.is_hdf5_file(fname):
+        with tables.open_file(fname, 'r') as fid:
+            size = int(np.prod(fid.root.data.shape))
+            if 'sr' in fid.root.__members__:
+                sr = fid.root.sr[...].ravel()[0]
+            else:
+                sr = DEFAULT_MAT_SR
+    else:
+        shapes = {name: shape for name, shape, _ in whosmat(fname)}
+        size = int(np.prod(shapes['data']))
+        if 'sr' in shapes:
+            sr = loadmat(fname, variable_names=['sr'])['sr'].ravel()[0]
+        else:
+            sr = DEFAULT_MAT_SR
+    return size, float(sr)
+
+
+class MatFile(object):
+    """
+    reads blocks of data from a matfile.
+    Matfiles of version 7.3 are HDF5 files and are read block by block,
+    older matfiles are loaded once
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self.h5file = None
+        sr = None
+        if tables.is_hdf5_file(fname):
+            self.h5file = tables.open_file(fname, 'r')
+            self.data = self.h5file.root.data
+            if 'sr' in self.h5file.root.__members__:
+                sr = self.h5file.root.sr[...].ravel()[0]
+        else:
+            mat = loadmat(fname)
+            self.data = mat['data'].ravel()
+            if 'sr' in mat:
+                sr = mat['sr'].ravel()[0]
+
+        if sr is None:
+            sr = DEFAULT_MAT_SR
+            insert = 'default'
+        else:
+            insert = 'stored'
+        print('Using ' + insert + ' sampling rate ({} kHz)'.format(sr/1000.))
+        self.sr = float(sr)
+        self.num_samples = int(np.prod(self.data.shape))
+
+    def read(self, start, stop):
+        """
+        read samples start to stop
+        """
+        # Matlab stores vectors as (1, n) or (n, 1) matrices
+        if self.h5file is not None and self.data.shape[0] == 1:
+            fdata = self.data[:, start:stop].ravel()
+        else:
+            fdata = self.data[start:stop].ravel()
+
+        return fdata, sample_times(start, fdata.shape[0], self.sr), 1/self.sr
+
+    def close(self):
+        """
+        close the file
+        """
+        if self.h5file is not None:
+            self.h5file.close()
+
 
 def read_matfile(fname):
     """
-    read data from a matfile
+    read all data from a matfile
     """
-    data = loadmat(fname)
+    matfile = MatFile(fname)
+    data = matfile.read(0, matfile.num_samples)
+    matfile.close()
+    return data
 
-    try:
-        sr = data['sr'].ravel()[0]
-        insert = 'stored'
-    except KeyError:
-        sr = DEFAULT_MAT_SR
-        insert = 'default'
 
-    print('Using ' + insert + ' sampling rate ({} kHz)'.format(sr/1000.))
-    ts = 1/sr
-    fdata = data['data'].ravel()
-    atimes = np.linspace(0, fdata.shape[0]/(sr/1000), fdata.shape[0])
-    # print(atimes.shape, fdata.shape)
-    # print(ts)
+class ExtractReader(object):
+    """
+    interface of the readers that feed mp_extract.
+    Data are addressed in records of SAMPLES_PER_REC samples,
+    subclasses set fname, num_recs, and timestep (in seconds)
+    and implement read_into
+    """
+    fname = None
+    num_recs = 0
+    timestep = None
 
-    return fdata, atimes, ts
+    def read(self, start, stop):
+        """
+        read records start to stop, in microvolts
+        """
+        fdata = np.empty((stop - start) * SAMPLES_PER_REC, np.float32)
+        atimes = self.read_into(start, stop, fdata)
+        return (fdata, atimes, self.timestep)
 
+    def read_into(self, start, stop, out):
+        """
+        read records start to stop into the float32 array out,
+        returns the timestamps
+        """
+        raise NotImplementedError
 
-class ExtractNcsFile(object):
+    def advise(self, start, stop):
+        """
+        hint that records start to stop will be read soon
+        """
+        pass
+
+
+class ExtractNcsFile(ExtractReader):
     """
     reads data from ncs file
     """
 
     def __init__(self, fname, ref_fname=None):
         self.fname = fname
-        self.ncs_file = NcsFile(fname)
+        self.ncs_file = NcsFile(fname, use_memmap=True)
+        self.num_recs = self.ncs_file.num_recs
+        self.timestep = self.ncs_file.timestep
         self.ref_file = ref_fname
         if ref_fname is not None:
-            self.ref_file = NcsFile(ref_fname)
-
-        stepus = self.ncs_file.timestep * 1e6
-
-        self.timerange = np.arange(0,
-                                   SAMPLES_PER_REC * stepus,
-                                   stepus)
+            self.ref_file = NcsFile(ref_fname, use_memmap=True)
 
         self.filter = DefaultFilter(self.ncs_file.timestep)
 
@@ -60,19 +188,27 @@ class ExtractNcsFile(object):
         """
         read data from an ncs file
         """
-        data, times = self.ncs_file.read(start, stop, 'both')
-        fdata = np.array(data).astype(np.float32)
-        fdata *= (1e6 * self.ncs_file.header['ADBitVolts'])
+        num_recs = self.ncs_file.view(start, stop, 'timestamp').shape[0]
+        fdata = np.empty(num_recs * SAMPLES_PER_REC, np.float32)
+        atimes = self.read_into(start, stop, fdata)
 
         if self.ref_file is not None:
-            print('Reading reference data from {}'.
-                format(self.ref_file.filename))
-            ref_data = self.ref_file.read(start, stop, 'data')
-            fref_data = np.array(ref_data).astype(np.float32)
-            fref_data *= 1e6 * self.ref_file.header['ADBitVolts']
-            fdata -= fref_data
-
-        expected_length = round((fdata.shape[0] - SAMPLES_PER_REC) *
+            fdata -= read_reference(self.ref_file, start, stop)
+
+        # MUST NOT USE dictionaries here, because they would persist in memory
+        return (fdata, atimes, self.ncs_file.timestep)
+
+    def read_into(self, start, stop, out):
+        """
+        read data (without reference) into the float32 array out,
+        returns the timestamps
+        """
+        # views into the memory map, converted in a single pass
+        data, times = self.ncs_file.view(start, stop, 'both')
+        out.reshape(data.shape)[:] = data
+        out *= (1e6 * self.ncs_file.header['ADBitVolts'])
+
+        expected_length = round((out.shape[0] - SAMPLES_PER_REC) *
                                 (self.ncs_file.timestep * 1e6))
 
         err = expected_length - times[-1] + times[0]
@@ -81,36 +217,297 @@ class ExtractNcsFile(object):
                   " between records {} and {}: {:.1f} ms"
                   .format(self.fname, start, stop, err/1e3))
 
-        atimes = np.hstack([t + self.timerange for t in times])/1e3
-        # MUST NOT USE dictionaries here, because they would persist in memory
-        return (fdata, atimes, self.ncs_file.timestep)
+        return BlockTimes(times/1e3, self.ncs_file.timestep * 1e3)
+
+    def advise(self, start, stop):
+        self.ncs_file.advise(start, stop)
+
+
+class InterleavedBinaryFile(ExtractReader):
+    """
+    reads one channel of a flat binary file with interleaved
+    samples of n_channels channels, e.g. the data of a Blackrock
+    NSx file. The file is memory-mapped, reading a block
+    de-interleaves the channel and scales it to microvolts.
+    Trailing samples that do not fill a record are not read.
+    """
+
+    def __init__(self, fname, n_channels, channel, sr, scale=1.,
+                 header_bytes=0, n_samples=None, start_time=0.,
+                 dtype='<i2'):
+        self.fname = fname
+        self.channel = channel
+        self.scale = scale
+        self.header_bytes = header_bytes
+        self.sr = float(sr)
+        self.timestep = 1/self.sr
+        self.start_time = start_time
+        self.dtype = np.dtype(dtype)
+        self.frame_bytes = n_channels * self.dtype.itemsize
+
+        if n_samples is None:
+            n_samples = (os.stat(fname).st_size - header_bytes) //\
+                self.frame_bytes
+        self.num_recs = n_samples // SAMPLES_PER_REC
+        self.memmap = np.memmap(fname, dtype=self.dtype, mode='r',
+                                offset=header_bytes,
+                                shape=(self.num_recs * SAMPLES_PER_REC,
+                                       n_channels))
+
+    def read_into(self, start, stop, out):
+        out[:] = self.memmap[start * SAMPLES_PER_REC:stop * SAMPLES_PER_REC,
+                             self.channel]
+        if self.scale != 1:
+            out *= self.scale
+
+        starts = self.start_time +\
+            np.arange(start, stop) * (SAMPLES_PER_REC * 1e3 / self.sr)
+        return BlockTimes(starts, 1e3 / self.sr)
+
+    def advise(self, start, stop):
+        if not hasattr(os, 'posix_fadvise'):
+            return
+        rec_bytes = SAMPLES_PER_REC * self.frame_bytes
+        fid = os.open(self.fname, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fid, self.header_bytes + start * rec_bytes,
+                             (stop - start) * rec_bytes,
+                             os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fid)
+
+
+def nsx_layout(fname):
+    """
+    reads the headers of a Blackrock NSx file (file spec 2.2 or 2.3),
+    returns the arguments of InterleavedBinaryFile
+    for the first data packet, and the channel labels
+    """
+    with open(fname, 'rb') as fid:
+        basic = fid.read(314)
+        if basic[:8] != b'NEURALCD':
+            raise IOError('{} is not an NSx file of version 2.2 or 2.3'.
+                          format(fname))
+        header_bytes, = np.frombuffer(basic[10:14], '<u4')
+        period, time_res = np.frombuffer(basic[286:294], '<u4')
+        n_channels, = np.frombuffer(basic[310:314], '<u4')
+
+        extended = np.frombuffer(fid.read(66 * n_channels),
+                                 np.dtype([('id', 'S2'),
+                                           ('electrode', '<u2'),
+                                           ('label', 'S16'),
+                                           ('frontend', 'u1', 2),
+                                           ('min_digital', '<i2'),
+                                           ('max_digital', '<i2'),
+                                           ('min_analog', '<i2'),
+                                           ('max_analog', '<i2'),
+                                           ('units', 'S16'),
+                                           ('filters', 'V20')]))
+
+        # data packet header: 0x01, timestamp, number of samples
+        fid.seek(header_bytes)
+        packet = fid.read(9)
+        timestamp, n_samples = np.frombuffer(packet[1:], '<u4')
+
+    # only the first data packet is read
+    data_end = int(header_bytes) + len(packet) +\
+        int(n_samples) * int(n_channels) * 2
+    file_size = os.stat(fname).st_size
+    if data_end < file_size:
+        if n_samples < SAMPLES_PER_REC:
+            raise IOError('{}: the first data packet has only {} samples,'
+                          ' files with several packets (e.g. one sample'
+                          ' per packet) are not supported'.
+                          format(fname, n_samples))
+        print('Warning: {} has more than one data packet (recording'
+              ' pauses?), only the first {} samples are read, {} bytes'
+              ' are ignored'.format(fname, n_samples, file_size - data_end))
+
+    unit_factors = {b'uV': 1., b'mV': 1e3, b'V': 1e6}
+    scales = [(float(ext['max_analog']) - ext['min_analog']) /
+              (float(ext['max_digital']) - ext['min_digital']) *
+              unit_factors.get(ext['units'].strip(b'\x00 '), 1.)
+              for ext in extended]
+    labels = [ext['label'].strip(b'\x00 ').decode() for ext in extended]
+
+    layout = {'n_channels': int(n_channels),
+              'sr': float(time_res) / period,
+              'header_bytes': int(header_bytes) + len(packet),
+              'n_samples': int(n_samples),
+              'start_time': int(timestamp) * 1e3 / time_res}
+
+    return layout, scales, labels
+
+
+def open_reader(job):
+    """
+    returns the reader for the channel of a job
+    """
+    if 'binary' in job:
+        return InterleavedBinaryFile(job['filename'], **job['binary'])
+    return ExtractNcsFile(job['filename'])
+
+
+def read_reference(ref_file, start, stop):
+    """
+    read reference data from an NcsFile, in microvolts
+    """
+    print('Reading reference data from {}'.format(ref_file.filename))
+    ref_data = ref_file.view(start, stop, 'data')
+    fref_data = ref_data.astype(np.float32).ravel()
+    fref_data *= 1e6 * ref_file.header['ADBitVolts']
+    return fref_data
+
+
+def read_bundle(readers, ref_file, start, stop, out=None):
+    """
+    read the same block from several ExtractReaders that share
+    the reference ref_file (an NcsFile, or None).
+    The reference is read once and subtracted from
+    the (n_channels, n_samples) array in one operation.
+    If out is given, data are read into it, e.g. into shared memory.
+    Returns the array, the timestamps of each reader,
+    and the timestep.
+    """
+    if out is None:
+        out = np.empty((len(readers), (stop - start) * SAMPLES_PER_REC),
+                       np.float32)
+    data = out
+    times = [reader.read_into(start, stop, data[i])
+             for i, reader in enumerate(readers)]
+
+    if ref_file is not None:
+        data -= read_reference(ref_file, start, stop)
+
+    return (data, times, readers[0].timestep)
+
+
+# chunk rows and compression of the spike files
+# 'default': pytables' automatic chunking, no compression
+# 'chunked': chunks of whole spikes, good for row-wise reading
+# 'blosc': like 'chunked', with fast Blosc/LZ4 compression
+H5_LAYOUTS = {'default': (None, None),
+              'chunked': (1024, None),
+              'blosc': (1024, ('blosc:lz4', 5))}
+
+# flush to disk after this many blocks
+FLUSH_EVERY = 10
+
+
+# earrays of a spike file, their lengths are stored in checkpoints
+EARRAYS = ('pos/spikes', 'pos/times', 'neg/spikes', 'neg/times', 'thr')
+
+
+# job entries that describe a block, stored with each checkpoint
+CHECKPOINT_KEYS = ('start', 'stop', 'blocksize', 'overlap')
+
+
+def checkpoint_block(job):
+    """
+    the entries of job that are stored with its checkpoint
+    """
+    return {key: int(job[key]) for key in CHECKPOINT_KEYS
+            if job.get(key) is not None}
+
+
+def checkpoint_fname(fname):
+    """
+    name of the checkpoint manifest of a spike file
+    """
+    return fname + '.checkpoint'
+
+
+def read_checkpoint(name, fname, destination=''):
+    """
+    returns the checkpoint manifest of a spike file,
+    or None if there is none
+    """
+    cname = checkpoint_fname(os.path.join(destination, name, fname))
+    if not os.path.exists(cname):
+        return None
+    with open(cname, 'r') as fid:
+        return json.load(fid)
 
 
 class OutFile(object):
     """
-    write out file to hdf5 tables
+    write out file to hdf5 tables.
+    Whenever the file is flushed, a checkpoint manifest
+    records the last written block (its count, start, stop,
+    block size, and overlap) and the lengths of all arrays.
+    With resume=True, an existing file is truncated to its checkpoint
+    and extended.
     """
-    def __init__(self, name, fname, spoints=64, destination=''):
+    def __init__(self, name, fname, spoints=64, destination='',
+                 layout='default', resume=False):
 
         dirname = os.path.join(destination, name)
         if not os.path.isdir(dirname):
             os.mkdir(dirname)
         fname = os.path.join(dirname, fname)
+        self.checkpoint_fname = checkpoint_fname(fname)
+        self.count = None
+        self.block = {}
+
+        if resume and os.path.exists(self.checkpoint_fname):
+            self.f = self.resume(fname)
+        else:
+            if os.path.exists(self.checkpoint_fname):
+                os.remove(self.checkpoint_fname)
+            self.f = self.create(fname, spoints, layout)
+        self.unflushed = 0
+
+    def create(self, fname, spoints, layout):
+        """
+        initialize a new file
+        """
         f = tables.open_file(fname, 'w')
         f.create_group('/', 'pos', 'positive spikes')
         f.create_group('/', 'neg', 'negative spikes')
 
+        chunkrows, compression = H5_LAYOUTS[layout]
+        if compression is not None:
+            filters = tables.Filters(complib=compression[0],
+                                     complevel=compression[1],
+                                     shuffle=True)
+        else:
+            filters = None
+
+        if chunkrows is not None:
+            spikes_chunkshape = (chunkrows, spoints)
+            times_chunkshape = (chunkrows,)
+        else:
+            spikes_chunkshape = times_chunkshape = None
+
         for sign in ('pos', 'neg'):
             f.create_earray('/' + sign, 'spikes',
-                           tables.Float32Atom(), (0, spoints))
-            f.create_earray('/' + sign, 'times', tables.FloatAtom(), (0,))
+                            tables.Float32Atom(), (0, spoints),
+                            filters=filters, chunkshape=spikes_chunkshape)
+            f.create_earray('/' + sign, 'times', tables.FloatAtom(), (0,),
+                            filters=filters, chunkshape=times_chunkshape)
 
         f.create_earray('/', 'thr', tables.FloatAtom(), (0, 3))
 
-        self.f = f
-        print('Initialized ' + fname)
+        print('Initialized {} (layout {})'.format(fname, layout))
+        return f
 
-    def write(self, data):
+    def resume(self, fname):
+        """
+        open an existing file and remove everything
+        written after the last checkpoint
+        """
+        with open(self.checkpoint_fname, 'r') as fid:
+            checkpoint = json.load(fid)
+        f = tables.open_file(fname, 'a')
+        for node in EARRAYS:
+            f.get_node('/' + node).truncate(checkpoint['rows'][node])
+        self.count = checkpoint['count']
+        self.block = {key: checkpoint[key] for key in CHECKPOINT_KEYS
+                      if checkpoint.get(key) is not None}
+        print('Resuming {} after block {}'.format(fname, self.count))
+        return f
+
+    def write(self, data, count=None, block=None):
         r = self.f.root
         posspikes = data[0][0]
         postimes = data[0][1]
@@ -127,7 +524,28 @@ class OutFile(object):
         # threshold data
         r.thr.append(data[2])
 
+        self.count = count
+        self.block = {} if block is None else block
+        self.unflushed += 1
+        if self.unflushed >= FLUSH_EVERY:
+            self.flush()
+
+    def flush(self):
         self.f.flush()
+        self.unflushed = 0
+        if self.count is None:
+            return
+
+        checkpoint = {'count': int(self.count),
+                      'rows': {node: int(self.f.get_node('/' + node).nrows)
+                               for node in EARRAYS}}
+        checkpoint.update(self.block)
+        # replace the manifest atomically
+        tmpname = self.checkpoint_fname + '.tmp'
+        with open(tmpname, 'w') as fid:
+            json.dump(checkpoint, fid)
+        os.replace(tmpname, self.checkpoint_fname)
 
     def close(self):
+        self.flush()
         self.f.close()
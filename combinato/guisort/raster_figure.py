@@ -70,12 +70,16 @@ def create_raster_rows(cl_times, onset_times):
     empty = [-2 * T_PRE]
     onset_times /= 1000
     do_plot = False
-    for onset_time in onset_times:
-        idx = (cl_times >= onset_time - T_PRE) &\
-              (cl_times <= onset_time + T_POST)
-        if idx.any():
+    cl_times = np.asarray(cl_times)
+    if (np.diff(cl_times) < 0).any():
+        cl_times = np.sort(cl_times)
+    # binary search for the window around each onset
+    starts = np.searchsorted(cl_times, onset_times - T_PRE, 'left')
+    stops = np.searchsorted(cl_times, onset_times + T_POST, 'right')
+    for onset_time, start, stop in zip(onset_times, starts, stops):
+        if stop > start:
             do_plot = True
-            rows.append(cl_times[idx] - onset_time)
+            rows.append(cl_times[start:stop] - onset_time)
         else:
             rows.append(empty)
     return rows, do_plot
@@ -9,7 +9,7 @@ import numpy as np
 import tables
 import os
 
-from .. import SIGNS, TYPE_NAMES, TYPE_ART, GROUP_NOCLASS, GROUP_ART, NcsFile,\
+from .. import SIGNS, TYPE_NAMES, TYPE_ART, GROUP_NOCLASS, GROUP_ART, ncs_header,\
     TYPE_NON_NOISE, TYPE_ALL
 
 debug = False
@@ -196,9 +196,7 @@ class SortingManagerGrouped(object):
                     break
 
         if name is not None:
-            fid = NcsFile(name)
-            self.header = fid.header
-            del fid
+            self.header = ncs_header(name)
             return
 
         for folder in cand_folders:
@@ -75,7 +75,7 @@ def overview_plot(channel):
     cscname = os.path.basename(channel)[:-4]
     sessionstarts = np.array(np.linspace(0, fid.num_recs, n_sessions), dtype=int)
     fignames = []
-    myfilter = DefaultFilter(timestep)
+    myfilter = DefaultFilter(timestep, np.float32)
     n_recs_load = int(MINS*60/(512*timestep))
 
     for i in range(3):
@@ -0,0 +1,184 @@
+# 2026-10-18
+"""
+sorted sets of closed time intervals,
+used for artifact bins and exclusion ranges
+"""
+from __future__ import print_function, division, absolute_import
+import numpy as np
+import tables
+
+
+class IntervalSet(object):
+    """
+    union of closed intervals [start, stop], stored as sorted,
+    disjoint arrays of starts and stops.
+    Intervals that overlap or touch are merged
+    """
+    def __init__(self, starts=(), stops=()):
+        starts = np.asarray(starts, dtype=float).ravel()
+        stops = np.asarray(stops, dtype=float).ravel()
+        if starts.shape != stops.shape:
+            raise ValueError('Need as many starts as stops')
+        if (stops < starts).any():
+            raise ValueError('Interval stops before it starts')
+
+        if starts.shape[0]:
+            order = np.argsort(starts, kind='mergesort')
+            starts = starts[order]
+            stops = np.maximum.accumulate(stops[order])
+            # a new interval begins where the start
+            # lies after all previous stops
+            new = np.hstack((True, starts[1:] > stops[:-1]))
+            last = np.hstack((new[1:], True))
+            starts = starts[new]
+            stops = stops[last]
+
+        self.starts = starts
+        self.stops = stops
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        """
+        create from a sequence of (start, stop) pairs
+        """
+        pairs = np.asarray(pairs, dtype=float).reshape(-1, 2)
+        return cls(pairs[:, 0], pairs[:, 1])
+
+    def __len__(self):
+        return self.starts.shape[0]
+
+    def __iter__(self):
+        return zip(self.starts, self.stops)
+
+    def __eq__(self, other):
+        return (np.array_equal(self.starts, other.starts) and
+                np.array_equal(self.stops, other.stops))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'IntervalSet({} intervals, {:.1f} total)'.\
+            format(len(self), self.total_length())
+
+    def total_length(self):
+        """
+        summed length of all intervals
+        """
+        return (self.stops - self.starts).sum()
+
+    def union(self, other):
+        """
+        intervals covered by self or other
+        """
+        return IntervalSet(np.hstack((self.starts, other.starts)),
+                           np.hstack((self.stops, other.stops)))
+
+    def intersection(self, other):
+        """
+        intervals covered by both self and other
+        """
+        # for each interval of self, the range of
+        # intervals in other that overlap it
+        first = np.searchsorted(other.stops, self.starts, 'left')
+        stop = np.searchsorted(other.starts, self.stops, 'right')
+        n_overlap = np.maximum(stop - first, 0)
+
+        own = np.repeat(np.arange(len(self)), n_overlap)
+        offsets = np.arange(own.shape[0]) -\
+            np.repeat(np.cumsum(n_overlap) - n_overlap, n_overlap)
+        theirs = first[own] + offsets
+
+        return IntervalSet(np.maximum(self.starts[own], other.starts[theirs]),
+                           np.minimum(self.stops[own], other.stops[theirs]))
+
+    def contains(self, times):
+        """
+        True for each of times that lies in one of the intervals,
+        times do not have to be sorted
+        """
+        times = np.asarray(times)
+        if not len(self):
+            return np.zeros(times.shape, dtype=bool)
+        # first interval that ends at or after each time
+        idx = np.searchsorted(self.stops, times, 'left')
+        inside = idx < len(self)
+        inside[inside] = self.starts[idx[inside]] <= times[inside]
+        return inside
+
+    def indices(self, times, closed=True):
+        """
+        for sorted times, index of the first time in each interval
+        and index after the last one.
+        With closed=False, intervals are treated as [start, stop)
+        """
+        side = 'right' if closed else 'left'
+        return (np.searchsorted(times, self.starts, 'left'),
+                np.searchsorted(times, self.stops, side))
+
+    def to_h5(self, h5file, where, name):
+        """
+        store as an (n, 2) array in an open h5 file,
+        replacing an existing node
+        """
+        path = where.rstrip('/') + '/' + name
+        if path in h5file:
+            h5file.remove_node(path)
+        h5file.create_array(where, name,
+                            np.vstack((self.starts, self.stops)).T
+                            .reshape(-1, 2), createparents=True)
+
+    @classmethod
+    def from_h5(cls, h5file, where, name):
+        """
+        read intervals stored by to_h5
+        """
+        return cls.from_pairs(h5file.get_node(where, name)[:])
+
+
+def test():
+    """
+    compares IntervalSet to boolean masks
+    """
+    rng = np.random.RandomState(0)
+    times = rng.uniform(-5, 115, 1000)
+
+    def random_set():
+        starts = rng.randint(0, 100, rng.randint(0, 10)).astype(float)
+        return IntervalSet(starts, starts + rng.randint(0, 10, len(starts)))
+
+    def mask(ivs):
+        ret = np.zeros(times.shape, dtype=bool)
+        for start, stop in ivs:
+            ret |= (times >= start) & (times <= stop)
+        return ret
+
+    for _ in range(500):
+        ivs1 = random_set()
+        ivs2 = random_set()
+        assert (ivs1.contains(times) == mask(ivs1)).all()
+        assert (ivs1.union(ivs2).contains(times) ==
+                (mask(ivs1) | mask(ivs2))).all()
+        assert (ivs1.intersection(ivs2).contains(times) ==
+                (mask(ivs1) & mask(ivs2))).all()
+        assert (np.diff(np.vstack((ivs1.starts, ivs1.stops)).T.ravel())
+                >= 0).all()
+
+    sorted_times = np.sort(times)
+    ivs = random_set()
+    first, after = ivs.indices(sorted_times)
+    for i, (start, stop) in enumerate(ivs):
+        assert (sorted_times[first[i]:after[i]] >= start).all()
+        assert (sorted_times[first[i]:after[i]] <= stop).all()
+
+    with tables.open_file('intervals_test.h5', 'w',
+                          driver='H5FD_CORE',
+                          driver_core_backing_store=0) as h5file:
+        ivs.to_h5(h5file, '/pos', 'test')
+        assert IntervalSet.from_h5(h5file, '/pos', 'test') == ivs
+
+    print('IntervalSet and boolean masks agree')
+
+
+if __name__ == '__main__':
+    test()
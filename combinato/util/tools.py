@@ -6,7 +6,7 @@ import os
 from glob import glob
 from collections import defaultdict
 import tables
-from .. import NcsFile, options
+from .. import ncs_header, flush_header_caches, options
 
 def check_sorted(channel_dirname):
     """
@@ -100,9 +100,9 @@ def get_channels(path, from_h5files=False):
     for chan in chs:
         statr = os.stat(chan)
         if statr.st_size > 16 * 1024:
-            fid = NcsFile(chan)
-            name = fid.header['AcqEntName']
+            name = ncs_header(chan)['AcqEntName']
             ret[name] = os.path.basename(chan)
+    flush_header_caches()
     return ret
 
 
@@ -114,9 +114,7 @@ def get_regions(path):
     for ch in channels:
         statr = os.stat(ch)
         if statr.st_size > 16 * 1024:
-            fh = NcsFile(ch)
-
-            name = fh.header['AcqEntName']
+            name = ncs_header(ch)['AcqEntName']
             try:
                 int(name[-1])
                 name = name[:-1]
@@ -128,6 +126,7 @@ def get_regions(path):
             
             regions[name].append(ch)
 
+    flush_header_caches()
     for name in regions:
         regions[name] = sorted(regions[name])
     return regions
@@ -30,6 +30,7 @@ class H5Manager(object):
         self.spm = None
         self.time_factors = {}
         self.events = {}
+        self.event_starts = {}
         self.modify = modify
         self.folder = os.path.dirname(files[0])
         self.init_meta()
@@ -170,7 +171,9 @@ class H5Manager(object):
 
     def get_events(self, ch, start, stop, trace):
         """
-        read events in the given window
+        read events in the given window.
+        The start indices of the events of a trace are read once,
+        then only the rows in the window are read
         """
         if ch in self.events:
             obj = self.events[ch]
@@ -178,12 +181,25 @@ class H5Manager(object):
             return []
 
         try:
-            # this is a bit unefficient because we just need
-            # certain parts, but it's not easy to do better
-            temp_d = obj.get_node('/', trace)[:, :]
+            node = obj.get_node('/', trace)
         except tables.NoSuchNodeError:
             return []
 
+        key = (ch, trace)
+        if key not in self.event_starts:
+            starts = node[:, 0]
+            # binary search needs sorted events
+            if (np.diff(starts) < 0).any():
+                starts = None
+            self.event_starts[key] = starts
+
+        starts = self.event_starts[key]
+        if starts is None:
+            temp_d = node[:, :]
+        else:
+            temp_d = node[np.searchsorted(starts, start, 'left'):
+                          np.searchsorted(starts, stop, 'right'), :]
+
         idx = (temp_d[:, 0] >= start) & (temp_d[:, 1] <= stop)
         return temp_d[idx, :]
 
@@ -22,7 +22,7 @@ def downsampling(ncsfname, h5fname, Q=16, include_times=True):
     """
     Main routine for downsampling
     """
-    ncsf = NcsFile(ncsfname)
+    ncsf = NcsFile(ncsfname, use_memmap=True)
     chname = ncsf.header['AcqEntName']
     h5f = initfile(h5fname, ncsf, Q, include_times)
     nrec = ncsf.num_recs
@@ -40,7 +40,9 @@ def downsampling(ncsfname, h5fname, Q=16, include_times=True):
 
     for start, stop in blocks:
         print('Filtering {} {}-{}'.format(chname, start, stop))
-        data, ts = ncsf.read(start, stop, mode='both')
+        # record-wise views into the memory map
+        data, ts = ncsf.view(start, stop, mode='both')
+        data = data.ravel()
 
         if include_times:
             h5f.root.time.append(ts)
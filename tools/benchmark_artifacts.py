@@ -0,0 +1,138 @@
+# 2026-10-18
+"""
+Benchmark artifact marking in mask_artifacts on synthetic spike times.
+The interval based functions are compared to the previous loops
+over bin edges and pairs of close spikes.
+"""
+from __future__ import division, print_function, absolute_import
+from argparse import ArgumentParser
+from time import time
+import numpy as np
+from combinato import IntervalSet
+from combinato.artifacts import mask_artifacts as ma
+
+CONC_BIN_MS = 3
+SPIKE_LEN = 64
+
+
+def loop_by_diff(times):
+    """
+    mark_by_diff as it was done before vectorization
+    """
+    bin_len = ma.options_by_diff['binlength']
+    max_per_bin = ma.options_by_diff['max_spk_per_bin']
+    artifacts = np.zeros(times.shape[0], dtype=bool)
+    for shift in (0, bin_len/2):
+        bins = np.arange(times[0] + shift, times[-1] + shift, bin_len)
+        if len(bins) < 2:
+            continue
+        counts, _ = np.histogram(times, bins)
+        for edge in bins[:-1][counts > max_per_bin]:
+            artifacts[(times >= edge) & (times <= edge + bin_len)] = True
+    return artifacts
+
+
+def loop_by_bincount(times, left_edges, bin_len):
+    """
+    mark_by_bincount as it was done before vectorization
+    """
+    artifacts = np.zeros(times.shape[0], dtype=bool)
+    for edge in left_edges:
+        artifacts[(times >= edge) & (times <= edge + bin_len)] = True
+    return artifacts
+
+
+def loop_double(times, spikes, sign):
+    """
+    mark_double_detection as it was done before vectorization
+    """
+    rel_idx = ma.options_double['relevant_idx']
+    artifacts = np.zeros(times.shape[0], dtype=bool)
+    for i in (np.diff(times) < ma.options_double['min_dist']).nonzero()[0]:
+        sp1 = spikes[i, rel_idx]
+        sp2 = spikes[i + 1, rel_idx]
+        if (sp1 > sp2) if sign == 'pos' else (sp1 < sp2):
+            artifacts[i + 1] = True
+        else:
+            artifacts[i] = True
+    return artifacts
+
+
+def synthetic_channel(rng, duration, rate, burst_times):
+    """
+    Poisson spike times in ms with dense bursts at burst_times,
+    and random spike amplitudes
+    """
+    n_spk = rng.poisson(rate * duration / 1000)
+    times = [rng.uniform(0, duration, n_spk)]
+    for start in burst_times:
+        # more than max_spk_per_bin spikes within one bin
+        times.append(start + rng.uniform(0, 300, 150))
+    times = np.sort(np.hstack(times))
+    spikes = rng.randn(times.shape[0], SPIKE_LEN).astype(np.float32) * 50
+    return times, spikes
+
+
+def main():
+    parser = ArgumentParser('benchmark_artifacts',
+                            description='compare interval based and looped'
+                                        ' artifact marking')
+    parser.add_argument('--channels', type=int, default=96)
+    parser.add_argument('--hours', type=float, default=2)
+    parser.add_argument('--rate', type=float, default=10,
+                        help='spike rate in Hz')
+    parser.add_argument('--bursts', type=int, default=200,
+                        help='high firing bursts per channel')
+    parser.add_argument('--concurrent-bins', type=int, default=5000,
+                        help='number of bins flagged as concurrent')
+    parser.add_argument('--compare', type=int, default=4,
+                        help='number of channels to also run the loops on')
+    args = parser.parse_args()
+
+    ma.DEBUG = False
+    rng = np.random.RandomState(1)
+    duration = args.hours * 3600 * 1000
+    conc_edges = np.sort(rng.choice(int(duration // CONC_BIN_MS),
+                                    args.concurrent_bins, replace=False)
+                         * CONC_BIN_MS).astype(float)
+    conc_intervals = IntervalSet(conc_edges, conc_edges + CONC_BIN_MS)
+
+    t_loop = t_vec = 0
+    n_spikes = n_marked = 0
+    for channel in range(args.channels):
+        bursts = rng.uniform(0, duration - 300, args.bursts)
+        times, spikes = synthetic_channel(rng, duration, args.rate, bursts)
+        n_spikes += times.shape[0]
+
+        t1 = time()
+        by_diff = ma.mark_by_diff(times)[0]
+        by_conc = ma.mark_by_bincount(times, conc_intervals)[0]
+        relevant = spikes[:, ma.options_double['relevant_idx']]
+        double = ma.mark_double_detection(times, relevant, 'pos')[0]
+        t_vec += time() - t1
+        n_marked += (by_diff | by_conc | double).sum()
+
+        if channel < args.compare:
+            t1 = time()
+            assert (loop_by_diff(times) == by_diff).all()
+            assert (loop_by_bincount(times, conc_edges, CONC_BIN_MS)
+                    == by_conc).all()
+            assert (loop_double(times, spikes, 'pos') == double).all()
+            t_loop += time() - t1
+
+    print('{} channels, {} spikes, {} marked as artifacts'.
+          format(args.channels, n_spikes, n_marked))
+    print('interval based: {:.2f} s for {} channels'.
+          format(t_vec, args.channels))
+    if args.compare:
+        n_comp = min(args.compare, args.channels)
+        per_ch_loop = t_loop / n_comp
+        per_ch_vec = t_vec / args.channels
+        print('loops: {:.2f} s per channel, {:.1f} s estimated for {}'
+              ' channels ({:.0f}x)'.
+              format(per_ch_loop, per_ch_loop * args.channels,
+                     args.channels, per_ch_loop / per_ch_vec))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+# 2026-10-18
+"""
+End-to-end benchmark of spike extraction from ncs files.
+Synthetic ncs files with spikes at known times are written,
+extracted with mp_extract, and the detected spikes
+are compared to the injected ones.
+"""
+from __future__ import division, print_function, absolute_import
+import os
+import shutil
+import tempfile
+from argparse import ArgumentParser
+from time import time
+import numpy as np
+import tables
+from combinato.basics.nlxio import ncs_type, NLX_OFFSET, NCS_SAMPLES_PER_REC
+from combinato.extract.mp_extract import mp_extract, peak_memory_mb
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+AD_BIT_VOLTS = 0.000000030517578125
+SAMPLING_RATE = 32000
+TS_START = 10 ** 9  # microseconds
+RECS_PER_CHUNK = 10000
+REFRACTORY = 100  # minimum distance between spikes in samples
+
+HEADER = '\r\n'.join(('######## Neuralynx Data File Header',
+                      '## File Name {fname}',
+                      '## Time Opened (m/d/y): 10/18/2026  '
+                      '(h:m:s.ms) 10:00:00.000',
+                      '-ADBitVolts {adbitvolts:.21f}',
+                      '-SamplingFrequency {sr}',
+                      '-ADChannel {channel}',
+                      '-AcqEntName {name}',
+                      '-RecordSize 1044', ''))
+
+
+def spike_template():
+    """
+    a simple spike shape with its maximum at index 19
+    """
+    x = np.arange(64)
+    template = np.exp(-(x - 19.)**2/4) - .3 * np.exp(-(x - 30.)**2/30)
+    return template / template.max()
+
+
+def write_synthetic_ncs(fname, num_recs, rng, rate=10, amplitude=150,
+                        noise=20, channel=0):
+    """
+    write an ncs file with Gaussian noise (std in microvolts)
+    and spikes of alternating sign at random times.
+    Returns the times of the spike maxima in milliseconds and their signs
+    """
+    name = os.path.splitext(os.path.basename(fname))[0]
+    header = HEADER.format(fname=fname, adbitvolts=AD_BIT_VOLTS,
+                           sr=SAMPLING_RATE, channel=channel, name=name)
+    template = spike_template()
+    rec_step = NCS_SAMPLES_PER_REC / SAMPLING_RATE * 1e6
+    factor = 1 / (AD_BIT_VOLTS * 1e6)
+
+    all_times = []
+    all_signs = []
+
+    with open(fname, 'wb') as fid:
+        fid.write(header.encode().ljust(NLX_OFFSET, b'\0'))
+
+        for start in range(0, num_recs, RECS_PER_CHUNK):
+            n_recs = min(RECS_PER_CHUNK, num_recs - start)
+            n_samples = n_recs * NCS_SAMPLES_PER_REC
+            signal = rng.randn(n_samples) * noise
+
+            n_spikes = rng.poisson(rate * n_samples / SAMPLING_RATE)
+            pos = np.unique(rng.randint(REFRACTORY, n_samples - REFRACTORY,
+                                        n_spikes))
+            pos = pos[np.diff(np.hstack((-REFRACTORY, pos))) >= REFRACTORY]
+            signs = rng.randint(2, size=pos.shape[0])
+            index = pos[:, np.newaxis] + np.arange(-19, 45)
+            signal[index] += amplitude * np.outer(1 - 2 * signs, template)
+
+            recs = np.zeros(n_recs, ncs_type)
+            recs['timestamp'] = np.round(TS_START +
+                                         (start + np.arange(n_recs)) *
+                                         rec_step)
+            recs['info'][:, 0] = channel
+            recs['info'][:, 1] = SAMPLING_RATE
+            recs['info'][:, 2] = NCS_SAMPLES_PER_REC
+            recs['data'] = np.clip(np.round(signal * factor), -32767, 32767).\
+                reshape(n_recs, NCS_SAMPLES_PER_REC)
+            fid.write(recs.tobytes())
+
+            all_times.append((TS_START + (start * NCS_SAMPLES_PER_REC + pos) /
+                              SAMPLING_RATE * 1e6) / 1e3)
+            all_signs.append(signs)
+
+    return np.hstack(all_times), np.hstack(all_signs)
+
+
+def make_jobs(fnames, num_recs, blocksize, destination, overlap=4):
+    """
+    jobs for mp_extract, as constructed by css-extract
+    """
+    jobs = []
+    if num_recs % blocksize > blocksize/2:
+        laststart = num_recs - blocksize
+    else:
+        laststart = num_recs
+    starts = list(range(0, laststart, blocksize))
+    stops = starts[1:] + [num_recs]
+
+    for fname in fnames:
+        name = os.path.splitext(os.path.basename(fname))[0]
+        for i, (start, stop) in enumerate(zip(starts, stops)):
+            jobs.append({'name': name,
+                         'filename': fname,
+                         'start': start,
+                         'stop': stop,
+                         'count': i,
+                         'overlap': overlap,
+                         'destination': destination,
+                         'h5_layout': 'default',
+                         'reference': None})
+    return jobs
+
+
+def matched(times, other, tolerance):
+    """
+    for each of times, True if a time in the sorted array other
+    is within tolerance
+    """
+    other = np.hstack((-np.inf, other, np.inf))
+    idx = np.searchsorted(other, times)
+    dist = np.minimum(times - other[idx - 1], other[idx] - times)
+    return dist <= tolerance
+
+
+def main():
+    parser = ArgumentParser('benchmark_extract',
+                            description='measure throughput, memory,'
+                                        ' and recall of css-extract'
+                                        ' on synthetic ncs files')
+    parser.add_argument('--channels', type=int, default=2)
+    parser.add_argument('--records', type=int, default=50000,
+                        help='records per channel (512 samples each)')
+    parser.add_argument('--blocksize', type=int, default=10000)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--savers', type=int, default=1)
+    parser.add_argument('--rate', type=float, default=10,
+                        help='spike rate in Hz')
+    parser.add_argument('--amplitude', type=float, default=150,
+                        help='spike amplitude in microvolts')
+    parser.add_argument('--tolerance', type=float, default=.5,
+                        help='tolerance for spike matching in ms')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--outdir',
+                        help='folder for files, default: temporary folder')
+    args = parser.parse_args()
+
+    if args.outdir is None:
+        outdir = tempfile.mkdtemp(prefix='combinato_benchmark_')
+    else:
+        outdir = args.outdir
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+
+    rng = np.random.RandomState(args.seed)
+    fnames = []
+    truth = {}
+    t1 = time()
+    for i in range(args.channels):
+        fname = os.path.join(outdir, 'CSC{}.ncs'.format(i + 1))
+        truth[fname] = write_synthetic_ncs(fname, args.records, rng,
+                                           args.rate, args.amplitude,
+                                           channel=i)
+        fnames.append(fname)
+    print('Wrote {} files in {:.1f} s'.format(len(fnames), time() - t1))
+
+    jobs = make_jobs(fnames, args.records, args.blocksize, outdir)
+    t1 = time()
+    mp_extract(jobs, args.workers, nSavers=args.savers)
+    runtime = time() - t1
+
+    total_recs = args.channels * args.records
+    print('Extracted {} records in {:.1f} s, {:.0f} records/s'.
+          format(total_recs, runtime, total_recs/runtime))
+    if resource is not None:
+        print('Peak memory: main process {:.0f} MB, largest child {:.0f} MB'.
+              format(peak_memory_mb(),
+                     resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+                     / 1024))
+
+    for fname in fnames:
+        name = os.path.splitext(os.path.basename(fname))[0]
+        true_times, true_signs = truth[fname]
+        h5fname = os.path.join(outdir, name, 'data_{}.h5'.format(name))
+        with tables.open_file(h5fname, 'r') as h5file:
+            for sign, label in enumerate(('pos', 'neg')):
+                found_times = np.sort(h5file.get_node('/' + label +
+                                                      '/times')[:])
+                sign_times = true_times[true_signs == sign]
+                n_found = matched(sign_times, found_times,
+                                  args.tolerance).sum()
+                # detections of spikes of the other sign are not counted
+                n_extra = (~matched(found_times, true_times,
+                                    args.tolerance)).sum()
+                print('{} {}: recall {}/{} ({:.1%}), {} false detections'.
+                      format(name, label, n_found, len(sign_times),
+                             n_found/max(len(sign_times), 1), n_extra))
+
+    if args.outdir is None:
+        shutil.rmtree(outdir)
+
+
+if __name__ == '__main__':
+    main()
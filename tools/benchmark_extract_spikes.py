@@ -0,0 +1,98 @@
+# 2026-10-18
+"""
+Benchmark the vectorized peak search and waveform gathering
+in extract_spikes against the previous Python loops
+"""
+from __future__ import division, print_function, absolute_import
+from argparse import ArgumentParser
+from time import time
+import numpy as np
+from combinato.extract.extract_spikes import find_maxima, gather_windows
+
+PRE = 24   # index_maximum + 5
+POST = 50  # indices_per_spike - index_maximum + 5
+
+
+def loop_maxima(data, borders, sign):
+    """
+    peak search as it was done before vectorization
+    """
+    if sign == 1:
+        detect_func = np.argmin
+    else:
+        detect_func = np.argmax
+    return np.array([detect_func(data[range(borders[i, 0], borders[i, 1])])
+                     + borders[i, 0] for i in range(borders.shape[0])],
+                    dtype=int)
+
+
+def loop_windows(data, maxima, pre, post):
+    """
+    waveform gathering as it was done before vectorization
+    """
+    extract_indices = [range(maxima[i] - pre, maxima[i] + post)
+                       for i in range(len(maxima))]
+    spikes = np.zeros((len(extract_indices), pre + post))
+    for i, _ in enumerate(extract_indices):
+        spikes[i] = data[extract_indices[i]]
+    return spikes
+
+
+def make_borders(data, threshold, max_len):
+    """
+    threshold crossings as computed in extract_spikes
+    """
+    borders = np.diff(data > threshold).nonzero()[0]
+    if data[0] > threshold:
+        borders = borders[1:]
+    if borders.shape[0] % 2:
+        borders = borders[:-1]
+    borders = borders.reshape(-1, 2)
+    return borders[(borders[:, 1] - borders[:, 0]) <= max_len]
+
+
+def timeit(func, *args):
+    """
+    returns result and runtime of func
+    """
+    t1 = time()
+    ret = func(*args)
+    return ret, time() - t1
+
+
+def main():
+    parser = ArgumentParser('benchmark_extract_spikes',
+                            description='compare vectorized and looped'
+                                        ' spike window extraction')
+    parser.add_argument('--samples', type=int, default=5120000,
+                        help='number of samples per block')
+    parser.add_argument('--threshold', type=float, default=2,
+                        help='threshold in units of noise, use a low'
+                             ' value to simulate a noisy channel')
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(1)
+    # smoothed noise, so that crossings last a few samples
+    data = np.convolve(rng.randn(args.samples), np.hanning(8), 'same')
+    data /= data.std()
+    borders = make_borders(data, args.threshold, 48)
+    print('{} samples, {} threshold crossings'.
+          format(args.samples, borders.shape[0]))
+
+    loop_max, t_loop_max = timeit(loop_maxima, data, borders, 0)
+    vec_max, t_vec_max = timeit(find_maxima, data, borders, 0)
+    assert (loop_max == vec_max).all()
+
+    maxima = vec_max[(vec_max >= PRE) & (vec_max < args.samples - POST)]
+    loop_spk, t_loop_spk = timeit(loop_windows, data, maxima, PRE, POST)
+    vec_spk, t_vec_spk = timeit(gather_windows, data, maxima, PRE, POST)
+    assert (loop_spk == vec_spk).all()
+
+    print('peak search: loop {:.3f} s, vectorized {:.3f} s ({:.0f}x)'.
+          format(t_loop_max, t_vec_max, t_loop_max/t_vec_max))
+    print('windows:     loop {:.3f} s, vectorized {:.3f} s ({:.0f}x)'.
+          format(t_loop_spk, t_vec_spk, t_loop_spk/t_vec_spk))
+
+
+if __name__ == '__main__':
+    main()